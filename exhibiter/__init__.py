@@ -2,12 +2,37 @@
 # This software may not be used to evict people, see LICENSE.md.
 
 # python standard imports
-from re import search, sub, fullmatch
+from re import search, sub, fullmatch, findall, DOTALL
 from pathlib import Path
 from copy import copy
+from hashlib import sha1
+from collections import OrderedDict
+from itertools import chain, islice
+from os import close, replace
+from base64 import a85decode
+import subprocess
+import sqlite3
+import json
+import sys
+import zlib
+from tempfile import mkstemp
+from threading import Thread
+from queue import Queue, Empty
 
 # third-party imports
-from pdfrw import PdfReader, PdfWriter, buildxobj, toreportlab
+from pdfrw import (
+    PdfReader,
+    PdfWriter,
+    PdfDict,
+    PdfArray,
+    PdfString,
+    PdfParseError,
+    buildxobj,
+    toreportlab,
+)
+from pdfrw.pdfwriter import user_fmt
+from pdfrw.tokens import PdfTokens
+from pdfrw.py23_diffs import convert_store
 from reportlab.lib import pagesizes, colors
 from reportlab.pdfgen.canvas import Canvas
 from docx.enum.text import WD_ALIGN_PARAGRAPH
@@ -15,10 +40,32 @@ from docx.enum.style import WD_STYLE_TYPE
 from docx import Document
 from PIL import Image
 
+# optional imports
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+MEMORY_LIMITS_SUPPORTED = resource is not None
+
 # global variables
 FILE_TYPES = ["png", "PNG", "jpg", "JPG", "jpeg", "JPEG", "pdf", "PDF"]
 EXCLUDE_PATTERN = r"\((UNUSED|[Uu]nused)\)"
 DISPUTE_FILE = "evidentiary disputes.txt"
+READER_CACHE_BYTES = 256 * 2**20  # the most source PDF data to keep parsed
+PARTIAL_SUFFIX = ".partial.pdf"
+TEXT_INDEX_SUFFIX = ".search.db"
+
+# functions to call with progress events, see subscribe()
+_listeners = []
+
+# helper processes for reading files with time or memory limits, keyed
+# by the memory limit, see _Sandbox
+_sandboxes = {}
+
+# parsed source PDFs, keyed by a hash of their contents, so that a
+# document shared by several exhibits (or several cases in a batch run)
+# is only parsed once per process. Values are (reader, file size).
+_reader_cache = OrderedDict()
 
 
 class Exhibit:
@@ -37,6 +84,14 @@ class Exhibit:
         page_label_coords: tuple = (50, 3),
         rotate_landscape_pics: bool = True,
         strip_leading_digits: bool = True,
+        render: bool = True,
+        time_limit: float = None,
+        memory_limit: int = None,
+        skip_failures: bool = False,
+        bates_prefix: str = None,
+        bates_start: int = 1,
+        bates_digits: int = 6,
+        extract_text: bool = False,
     ):
         """
         This constructor makes an exhibit from a given folder or file.
@@ -48,7 +103,31 @@ class Exhibit:
         The exhibit folder should contain one or more documents. A
         document means a file in the FILE_TYPES list, or a folder full
         of such files. Documents whose names contain "(UNUSED)" will
-        normally be omitted."""
+        normally be omitted.
+
+        If render is False, the documents' pages are only counted, not
+        drawn. This is a quick way to find every document's page span,
+        e.g. for writing the exhibit list before the PDF is ready.
+
+        If a time_limit (in seconds) or memory_limit (in megabytes) is
+        given, each file is read in a separate process, which is stopped
+        if it exceeds either limit. A file that fails this way is
+        replaced with a placeholder page, or left out entirely if
+        skip_failures is True, and listed in the exhibit's failures.
+        Memory limits aren't available on Windows (see
+        MEMORY_LIMITS_SUPPORTED).
+
+        If a bates_prefix is given, pages are labeled with Bates numbers
+        instead of exhibit page numbers, e.g. "SMITH000101" for a prefix
+        of "SMITH", bates_start of 101 and 6 bates_digits. bates_start
+        is the number of the exhibit's first page after the cover.
+
+        If extract_text is True, the text of each PDF page is saved in
+        the exhibit's page_texts while rendering, for write_text_index().
+
+        The exhibit's fingerprint is a hash of these options and of the
+        names, sizes and modification times of its files, so an exhibit
+        with the same fingerprint as before doesn't need rendering again."""
 
         # throw error if filename is wrong
         if not fullmatch("^(\d+|[A-Y])(\.?( .+)?)?", exhibit_path.stem):
@@ -105,8 +184,19 @@ class Exhibit:
             page_label_coords = page_label_coords,
             rotate_landscape_pics = rotate_landscape_pics,
             evidentiary_disputes = evidentiary_disputes,
+            render = render,
+            time_limit = time_limit,
+            memory_limit = memory_limit,
+            skip_failures = skip_failures,
+            bates_prefix = bates_prefix,
+            bates_start = bates_start,
+            bates_digits = bates_digits,
+            extract_text = extract_text,
         )
 
+        if render:
+            _emit("exhibit_started", index=index, title=title, path=exhibit_path)
+
         # add all evidence from the path to it
         if exhibit_path.is_dir():
             for path in evidence_in_dir(exhibit_path, respect_exclusions):
@@ -116,7 +206,29 @@ class Exhibit:
                 exhibit_path,
                 title=sub("^(\d+|[A-Z])\. ", "", exhibit_path.stem)
             )
-        
+
+        # record what went into the exhibit, so that write_pdf() can
+        # tell whether an existing PDF already contains it
+        exhibit._root = exhibit_path if exhibit_path.is_dir() else exhibit_path.parent
+        exhibit._settings = [
+            index,
+            title,
+            evidentiary_disputes,
+            respect_exclusions,
+            number_pages,
+            list(page_label_coords),
+            rotate_landscape_pics,
+            strip_leading_digits,
+            time_limit,
+            memory_limit,
+            skip_failures,
+            bates_prefix,
+            bates_digits,
+        ]
+        exhibit._set_fingerprint()
+
+        if render:
+            _emit("exhibit_finished", index=index, pages=exhibit.page_count)
         return exhibit
 
     def __init__(
@@ -127,19 +239,34 @@ class Exhibit:
         page_label_coords: tuple = (50, 3),
         rotate_landscape_pics: bool = True,
         evidentiary_disputes: str = None,
+        render: bool = True,
+        time_limit: float = None,
+        memory_limit: int = None,
+        skip_failures: bool = False,
+        bates_prefix: str = None,
+        bates_start: int = 1,
+        bates_digits: int = 6,
+        extract_text: bool = False,
     ):
         """
         This creates a bare-bones exhibit with only a cover sheet.
         You can then populate it by running add_doc() one or more times.
+        If render is False, the exhibit has no canvas, and add_doc()
+        only counts pages. See from_path() for the other options.
         """
+        if memory_limit and not MEMORY_LIMITS_SUPPORTED:
+            raise NotImplementedError("Memory limits aren't supported on this system.")
 
         # make a canvas write a cover page like "EXHIBIT 101"
-        canvas = Canvas("never_save_to_this_path.pdf")
-        canvas.setPageSize(pagesizes.letter)
-        canvas.setFont("Helvetica", 32)
-        x, y = canvas._pagesize[0] / 2, canvas._pagesize[1] / 7
-        canvas.drawCentredString(x, y, f"EXHIBIT {index}")
-        canvas.showPage()
+        if render:
+            canvas = Canvas("never_save_to_this_path.pdf")
+            canvas.setPageSize(pagesizes.letter)
+            canvas.setFont("Helvetica", 32)
+            x, y = canvas._pagesize[0] / 2, canvas._pagesize[1] / 7
+            canvas.drawCentredString(x, y, f"EXHIBIT {index}")
+            canvas.showPage()
+        else:
+            canvas = None
 
         # set this exhibit's various variables
         self.canvas: Canvas = canvas
@@ -151,6 +278,82 @@ class Exhibit:
         self.rotate_landscape_pics: bool = rotate_landscape_pics
         self.page_label_coords: tuple = page_label_coords
         self.page_count: int = 0
+        self.render: bool = render
+        self.time_limit: float = time_limit
+        self.memory_limit: int = memory_limit
+        self.skip_failures: bool = skip_failures
+        self.failures: list = []
+        self.bates_prefix: str = bates_prefix
+        self.bates_start: int = bates_start
+        self.bates_digits: int = bates_digits
+        self.fingerprint: str = None
+        self.page_texts: list = [] if extract_text and render else None
+        self._files: list = []
+        self._root: Path = None
+        self._settings: list = None
+        self._pdf_data: bytes = None
+        self._sources: list = []
+        self._resources = _ResourcePool()
+
+    def renumber(self, bates_start: int):
+        """
+        Change the Bates number of the first page after the cover, for an
+        exhibit that hasn't been rendered. This lets exhibits be scanned
+        in parallel, and numbered once the page counts before them are
+        known.
+        """
+        if self.render:
+            raise ValueError(f"Exhibit {self.index} has already been rendered.")
+        self.bates_start = bates_start
+        if self._settings is not None:
+            self._set_fingerprint()
+
+    def _set_fingerprint(self):
+        """
+        Hash the exhibit's settings and files; see from_path(). Paths are
+        relative to the exhibit's folder, so that the fingerprint doesn't
+        depend on where the input folder is, or how it was named. The
+        Bates start only counts if the pages have Bates numbers.
+        """
+        files = []
+        for path in self._files:
+            stat = path.stat()
+            name = path.relative_to(self._root).as_posix()
+            files.append([name, stat.st_size, stat.st_mtime_ns])
+        bates_start = self.bates_start if self.bates_prefix is not None else None
+        fingerprint = json.dumps([self._settings, bates_start, files])
+        self.fingerprint = sha1(fingerprint.encode()).hexdigest()
+
+    @property
+    def pdf_data(self) -> bytes:
+        """
+        The finished PDF for this exhibit. Once this has been read, no
+        more documents can be added to the exhibit.
+        """
+        if self._pdf_data is None:
+            if not self.render:
+                raise ValueError(f"Exhibit {self.index} was not rendered.")
+            self._pdf_data = self.canvas.getpdfdata()
+            # drop the cached reader's links to this canvas so that it
+            # can be garbage-collected
+            seen = set()
+            for xobj in self._sources:
+                _forget_doc(xobj, self.canvas._doc, seen)
+            self._sources = []
+            self._resources = None
+        return self._pdf_data
+
+    def __getstate__(self):
+        """
+        Exhibits are pickled as their finished PDF data rather than a
+        live canvas, so that they can be rendered in worker processes.
+        """
+        if self.render:
+            self.pdf_data
+        state = self.__dict__.copy()
+        state["canvas"] = None
+        state["_resources"] = None
+        return state
 
     def add_doc(
         self,
@@ -161,31 +364,36 @@ class Exhibit:
     ):
         """
         Adds a document (i.e. an image, PDF, or a folder of either)
-        to this exhibit.
+        to this exhibit. A document that ends up with no pages, e.g.
+        because its files failed and skip_failures is True, is left out
+        of the exhibit's documents.
         """
         startpage = self.page_count + 1
 
         if not title:
             title = _process_filename(doc_path.name, strip_leading_digits)
 
-        
-        if doc_path.is_dir():  # walk through directory and add files to doc
-            file_paths = []
-            for extension in FILE_TYPES:
-                file_paths += doc_path.glob("**/*." + extension)
-
-            # add each file in order, except the ones marked for omission
-            for path in sorted(file_paths):
-                if respect_exclusions and search(EXCLUDE_PATTERN, path.name):
-                    continue
+        for path in files_in_doc(doc_path, respect_exclusions):
+            self._files.append(path)
+            if self.time_limit or self.memory_limit:
+                self._insert_isolated(path)
+            elif self.render:
                 self._insert_pdf_or_image(path)
+            else:
+                self.page_count += count_pages(path)
+        if self.page_count < startpage:
+            return  # every file was left out, e.g. by skip_failures
 
-        else: # add single-file document to exhibit
-            self._insert_pdf_or_image(doc_path)
-        
         self.documents.append(
             {"name": title, "page_span": (startpage, self.page_count), "path": doc_path}
         )
+        if self.render:
+            _emit(
+                "document_finished",
+                index=self.index,
+                name=title,
+                page_span=(startpage, self.page_count),
+            )
 
     def _insert_pdf_or_image(self, path: Path):
         """
@@ -194,12 +402,7 @@ class Exhibit:
         """
 
         if path.suffix in [".pdf", ".PDF"]:
-            pages = PdfReader(path).pages
-            pages = [buildxobj.pagexobj(page) for page in pages]
-            for page in pages:
-                self.canvas.setPageSize((page.BBox[2], page.BBox[3]))
-                self.canvas.doForm(toreportlab.makerl(self.canvas, page))
-                self._finish_page()
+            self._insert_pages(_read_pdf(path).pages)
 
         elif path.suffix[1:] in FILE_TYPES:  # treat path as an image
             self.canvas.setPageSize(pagesizes.letter)
@@ -229,20 +432,102 @@ class Exhibit:
         else:
             raise SyntaxError(f"{path} is not a supported type: {FILE_TYPES}")
 
+    def _insert_pages(self, pages: list):
+        """Add the given pdfrw pages to the exhibit."""
+        pages = [buildxobj.pagexobj(page) for page in pages]
+        for page in pages:
+            page.Resources = self._resources.share(page.Resources, True)
+        self._sources += pages
+        for page in pages:
+            self.canvas.setPageSize((page.BBox[2], page.BBox[3]))
+            self.canvas.doForm(toreportlab.makerl(self.canvas, page))
+            self._finish_page()
+            if self.page_texts is not None:
+                # the text is only for searching, so a page whose content
+                # can't be parsed is indexed without any
+                try:
+                    text = _form_text(page)
+                except Exception:
+                    text = ""
+                self.page_texts.append((self.page_label(self.page_count), text))
+
+    def _insert_isolated(self, path: Path):
+        """
+        Like _insert_pdf_or_image(), but read the file in a helper
+        process, subject to the exhibit's time and memory limits. The
+        helper draws the file on pages of a fresh PDF, which is then
+        copied into this exhibit.
+        """
+        sandbox = _sandboxes.get(self.memory_limit)
+        if sandbox is None:
+            sandbox = _sandboxes[self.memory_limit] = _Sandbox(self.memory_limit)
+        request = [
+            "render" if self.render else "count",
+            str(path),
+            self.rotate_landscape_pics,
+        ]
+        try:
+            data = sandbox.run(request, self.time_limit)
+        except _SandboxError as e:
+            reason = str(e)
+        else:
+            if self.render:
+                # skip the other PDF's cover sheet
+                self._insert_pages(PdfReader(fdata=data).pages[1:])
+            else:
+                self.page_count += int(data)
+            return
+
+        self.failures.append((path, reason))
+        if self.render:
+            _emit("document_failed", index=self.index, path=path, reason=reason)
+        if self.skip_failures:
+            return
+        if self.render:
+            self._insert_placeholder(path, reason)
+        else:
+            self.page_count += 1
+
+    def _insert_placeholder(self, path: Path, reason: str):
+        """Add a page explaining that a file could not be included."""
+        self.canvas.setPageSize(pagesizes.letter)
+        self.canvas.setFont("Helvetica", 14)
+        x, y = self.canvas._pagesize[0] / 2, self.canvas._pagesize[1] / 2
+        self.canvas.drawCentredString(x, y + 20, "This file could not be included:")
+        self.canvas.drawCentredString(x, y, path.name)
+        self.canvas.setFont("Helvetica", 10)
+        self.canvas.drawCentredString(x, y - 20, f"It {reason}.")
+        self._finish_page()
+
+    def page_label(self, page: int) -> str:
+        """
+        Get the label for a page of this exhibit (counting from 1 after
+        the cover sheet), like "101-3" or a Bates number.
+        """
+        if self.bates_prefix is not None:
+            number = self.bates_start + page - 1
+            return f"{self.bates_prefix}{number:0{self.bates_digits}}"
+        return f"{self.index}-{page}"
+
     def _finish_page(self):
         """Print a page number (maybe), then move on to the next page."""
         self.page_count += 1
         if self.number_pages:
-            string = f"{self.index}-{self.page_count}"
+            string = self.page_label(self.page_count)
             mid = [
                 self.canvas._pagesize[x] * self.page_label_coords[x] / 100
                 for x in [0, 1]
             ]
+            # make the label's background wide enough for long labels
+            width = max(50, self.canvas.stringWidth(string) + 10)
             self.canvas.setFillColor(colors.white)
-            self.canvas.rect(mid[0] - 25, mid[1] - 4, 50, 15, stroke=0, fill=1)
+            self.canvas.rect(
+                mid[0] - width / 2, mid[1] - 4, width, 15, stroke=0, fill=1
+            )
             self.canvas.setFillColor(colors.black)
             self.canvas.drawCentredString(mid[0], mid[1], string)
         self.canvas.showPage()
+        _emit("page_rendered", index=self.index, page=self.page_count)
 
     def __str__(self):
         return self.path.stem
@@ -253,13 +538,362 @@ class Exhibit:
 # ######################################################################
 
 
-def write_pdf(exhibits: list[Exhibit], output_path: str):
-    """Save the given list of exhibits to a PDF document."""
+def write_pdf(
+    exhibits: list[Exhibit],
+    output_path: str,
+    linearize: bool = False,
+    append: bool = False,
+):
+    """
+    Save the given list of exhibits to a PDF document. The exhibits may
+    also be any other iterable, like a generator that yields each one as
+    soon as it has been rendered.
+
+    If linearize is True, the PDF is saved in "fast web view" form, so
+    that browser-based viewers can show the first page before the rest
+    of the file has downloaded. This requires pikepdf.
+
+    If append is True, and the output file is an earlier PDF whose
+    exhibits have the same fingerprints as the first ones given, only
+    the remaining exhibits are written, as an incremental update at the
+    end of the file. The earlier exhibits aren't rendered, so they can
+    be unrendered outlines. Otherwise, the whole file is rewritten.
+    Appending can't keep a PDF linearized, so it's ignored if linearize
+    is True.
+    """
+    exhibits = iter(exhibits)
+    if append and not linearize:
+        recorded = read_fingerprints(output_path)
+        done = list(islice(exhibits, len(recorded)))
+        if recorded and [e.fingerprint for e in done] == recorded:
+            _append_pdf(exhibits, output_path, recorded)
+            _emit("stage_done", stage="pdf", path=output_path)
+            return
+        exhibits = chain(done, exhibits)
+
+    if linearize:
+        try:
+            import pikepdf
+        except ImportError:
+            raise ImportError(
+                "Linearized PDFs require pikepdf. You can install it with"
+                + " 'python3 -m pip install pikepdf'."
+            )
+        # write a normal PDF next to the output, then linearize it
+        fd, temp_path = mkstemp(suffix=".pdf", dir=Path(output_path).parent)
+        close(fd)
+        try:
+            _write_pdfrw(exhibits, temp_path)
+            with pikepdf.open(temp_path) as pdf:
+                pdf.save(output_path, linearize=True)
+        finally:
+            Path(temp_path).unlink()
+    else:
+        _write_pdfrw(exhibits, output_path)
+    _emit("stage_done", stage="pdf", path=output_path)
+
+
+def _write_pdfrw(exhibits: list[Exhibit], output_path: str):
     writer = PdfWriter()
+    resources = _ResourcePool()
+    fingerprints = []
     for exhibit in exhibits:
-        reader = PdfReader(fdata=exhibit.canvas.getpdfdata())
+        reader = PdfReader(fdata=exhibit.pdf_data)
+        for page in reader.pages:
+            page.Resources = resources.share(page.Resources)
         writer.addpages(reader.pages)
-    writer.write(output_path)
+        fingerprints.append(exhibit.fingerprint)
+    if None not in fingerprints:
+        writer.trailer.Info = PdfDict(
+            ExhibiterExhibits=PdfString.from_unicode(json.dumps(fingerprints))
+        )
+    with open(output_path, "wb") as f:
+        progress_file = _ProgressFile(f, output_path)
+        writer.write(progress_file)
+        progress_file.flush()
+
+
+def _append_pdf(exhibits, output_path: str, fingerprints: list):
+    """
+    Add exhibits to the end of a PDF made by write_pdf(), by writing an
+    incremental update: their pages, plus new versions of the page tree
+    and metadata, are written after the end of the file, leaving the
+    existing bytes untouched.
+    """
+    data = Path(output_path).read_bytes()
+    reader = PdfReader(fdata=data)
+    update = _PdfUpdate(reader)
+    update.keep(reader.Root)
+
+    # add the new pages to the end of the root of the page tree
+    pages = reader.Root.Pages
+    update.replace(pages)
+    kids = []
+    for kid in pages.Kids:
+        update.keep(kid)
+        kids.append(kid)
+    count = int(pages.Count)
+    resources = _ResourcePool()
+    for exhibit in exhibits:
+        for page in PdfReader(fdata=exhibit.pdf_data).pages:
+            page.Resources = resources.share(page.Resources)
+            page.Parent = pages
+            kids.append(page)
+            count += 1
+        fingerprints.append(exhibit.fingerprint)
+    if count == int(pages.Count):
+        return  # nothing to add
+    pages.Kids = PdfArray(kids)
+    pages.Count = count
+
+    info = PdfDict(reader.Info or {})
+    info.ExhibiterExhibits = PdfString.from_unicode(json.dumps(fingerprints))
+    info.indirect = True
+    update.trailer.Root = reader.Root
+    update.trailer.Info = info
+    if reader.ID:
+        update.trailer.ID = reader.ID
+
+    with open(output_path, "ab") as f:
+        progress_file = _ProgressFile(f, output_path)
+        update.write(progress_file, len(data), _startxref(data))
+        progress_file.flush()
+
+
+def read_fingerprints(pdf_path: str) -> list:
+    """
+    Get the fingerprints of the exhibits in a PDF made by write_pdf(),
+    in order. Returns an empty list if the PDF doesn't exist, or doesn't
+    record its exhibits' fingerprints.
+    """
+    try:
+        info = PdfReader(str(pdf_path)).Info
+    except (OSError, PdfParseError):
+        return []
+    if not info or not info.ExhibiterExhibits:
+        return []
+    return json.loads(info.ExhibiterExhibits.to_unicode())
+
+
+def _startxref(data: bytes) -> int:
+    """Find where the last cross-reference section in a PDF starts."""
+    return int(data[data.rindex(b"startxref") + 9:].split()[0])
+
+
+class _PdfUpdate:
+    """
+    Formats an incremental update to an existing PDF, i.e. some new or
+    replaced objects and a cross-reference section listing them. pdfrw
+    can only write whole files, so this formats objects the same way as
+    PdfWriter does, but numbers them after the existing file's objects.
+    """
+
+    def __init__(self, reader: PdfReader):
+        self.size = int(reader.Size)
+        self.trailer = PdfDict()
+        self.numbers = {}  # id of an object: its (number, generation)
+        # objects to write; this also keeps them alive, so ids stay unique
+        self.queue = []
+
+    def keep(self, obj):
+        """Refer to an object of the existing file where it's used."""
+        self.numbers[id(obj)] = obj.indirect
+
+    def replace(self, obj):
+        """Write a new version of an object of the existing file."""
+        self.numbers[id(obj)] = obj.indirect
+        self.queue.append(obj)
+
+    def write(self, f, offset: int, prev: int):
+        """
+        Write the update to a file whose existing contents are `offset`
+        bytes long, and whose last cross-reference section is at `prev`.
+        """
+        trailer = self._format(self.trailer)  # numbers everything
+        formatted = {}
+        for obj in self.queue:  # grows as new objects are referenced
+            formatted[self.numbers[id(obj)]] = self._format(obj)
+
+        offsets = {}
+        for number, generation in sorted(formatted):
+            chunk = f"{number} {generation} obj\n{formatted[number, generation]}"
+            chunk = convert_store(f"\n{chunk}\nendobj")
+            offsets[number] = (offset + 1, generation)
+            f.write(chunk)
+            offset += len(chunk)
+
+        # one subsection of the cross-reference table per run of numbers
+        xref = ["\nxref"]
+        numbers = sorted(offsets)
+        while numbers:
+            run = 1
+            while run < len(numbers) and numbers[run] == numbers[0] + run:
+                run += 1
+            xref.append(f"{numbers[0]} {run}")
+            for number in numbers[:run]:
+                xref.append("%010d %05d n\r" % offsets[number])
+            numbers = numbers[run:]
+        trailer = trailer[:-2] + f" /Prev {prev} /Size {self.size}>>"
+        xref.append(f"trailer\n\n{trailer}\nstartxref\n{offset + 1}\n%%EOF\n")
+        f.write(convert_store("\n".join(xref)))
+
+    def _reference(self, obj) -> str:
+        key = self.numbers.get(id(obj))
+        if key is None:
+            key = self.numbers[id(obj)] = (self.size, 0)
+            self.queue.append(obj)
+            self.size += 1
+        return "%s %s R" % key
+
+    def _format(self, obj) -> str:
+        if isinstance(obj, PdfDict):
+            pairs = sorted(
+                (getattr(key, "encoded", None) or key, value)
+                for key, value in obj.iteritems()
+            )
+            result = "<<%s>>" % " ".join(
+                f"{key} {self._add(value)}" for key, value in pairs
+            )
+            if obj.stream is not None:
+                result = f"{result}\nstream\n{obj.stream}\nendstream"
+            return result
+        if isinstance(obj, PdfArray):
+            return "[%s]" % " ".join(self._add(value) for value in obj)
+        if hasattr(obj, "indirect"):
+            return str(getattr(obj, "encoded", None) or obj)
+        return user_fmt(obj)
+
+    def _add(self, obj) -> str:
+        if isinstance(obj, PdfDict):
+            indirect = obj.indirect or obj.stream is not None
+        else:
+            indirect = getattr(obj, "indirect", False)
+        if indirect:
+            return self._reference(obj)
+        return self._format(obj)
+
+
+def write_partial(exhibit: Exhibit, output_path: Path, position: int, total: int):
+    """
+    Save a rendered exhibit, cover sheet and all, as a "partial" PDF that
+    read_partials() can later combine with the others. The PDF's metadata
+    records the exhibit's details and page spans for write_list(), and
+    that it is exhibit number `position` (counting from 0) of `total`.
+    """
+    description = {
+        "position": position,
+        "total": total,
+        "index": exhibit.index,
+        "title": exhibit.title,
+        "evidentiary_disputes": exhibit.evidentiary_disputes,
+        "number_pages": exhibit.number_pages,
+        "bates_prefix": exhibit.bates_prefix,
+        "bates_start": exhibit.bates_start,
+        "bates_digits": exhibit.bates_digits,
+        "page_count": exhibit.page_count,
+        "fingerprint": exhibit.fingerprint,
+        "documents": [
+            {
+                "name": doc["name"],
+                "page_span": doc["page_span"],
+                "path": str(doc["path"]),
+            }
+            for doc in exhibit.documents
+        ],
+    }
+    writer = PdfWriter()
+    writer.addpages(PdfReader(fdata=exhibit.pdf_data).pages)
+    writer.trailer.Info = PdfDict(
+        Exhibiter=PdfString.from_unicode(json.dumps(description))
+    )
+    # write to a temporary file first, so that other processes never see
+    # a half-written partial, even if two of them render the same one
+    fd, temp_path = mkstemp(suffix=".tmp", dir=Path(output_path).parent)
+    close(fd)
+    try:
+        writer.write(temp_path)
+        replace(temp_path, output_path)
+    finally:
+        Path(temp_path).unlink(missing_ok=True)
+
+
+def read_partials(paths: list) -> list[Exhibit]:
+    """
+    Load partial PDFs made by write_partial(), and return their exhibits
+    in order, ready for write_pdf() and write_list(). Raises an error if
+    any exhibits are missing, if the partials disagree on how many
+    exhibits there are, or if their Bates numbers don't run on from one
+    exhibit to the next.
+    """
+    exhibits = {}
+    totals = set()
+    for path in paths:
+        description = _partial_description(path)
+        if description is None:
+            raise SyntaxError(f"{path} is not a partial PDF from Exhibiter.")
+        exhibit = Exhibit(
+            description["index"],
+            description["title"],
+            number_pages=description["number_pages"],
+            evidentiary_disputes=description["evidentiary_disputes"],
+            render=False,
+            bates_prefix=description["bates_prefix"],
+            bates_start=description["bates_start"],
+            bates_digits=description["bates_digits"],
+        )
+        exhibit.page_count = description["page_count"]
+        exhibit.fingerprint = description.get("fingerprint")
+        exhibit.documents = [
+            {
+                "name": doc["name"],
+                "page_span": tuple(doc["page_span"]),
+                "path": Path(doc["path"]),
+            }
+            for doc in description["documents"]
+        ]
+        exhibit._pdf_data = Path(path).read_bytes()
+        exhibits[description["position"]] = exhibit
+        totals.add(description["total"])
+
+    if not exhibits:
+        raise FileNotFoundError("No partial PDFs were found.")
+    if len(totals) > 1:
+        raise ValueError(
+            "The partial PDFs were rendered from input folders with different"
+            + f" numbers of exhibits ({', '.join(map(str, sorted(totals)))})."
+            + " Please delete the out-of-date ones and render them again."
+        )
+    total = totals.pop()
+    missing = [str(i) for i in range(total) if i not in exhibits]
+    if missing:
+        raise FileNotFoundError(
+            f"Missing partial PDFs for {len(missing)} of {total} exhibits"
+            + f" (positions {', '.join(missing)})."
+        )
+    exhibits = [exhibits[i] for i in range(total)]
+    for before, after in zip(exhibits, exhibits[1:]):
+        if after.bates_prefix is None:
+            continue
+        if after.bates_start != before.bates_start + before.page_count:
+            raise ValueError(
+                f"Exhibit {after.index}'s Bates numbers don't follow on from"
+                + f" exhibit {before.index}'s. Please render it again."
+            )
+    return exhibits
+
+
+def _partial_description(path: Path) -> dict:
+    """
+    Get the details that write_partial() recorded in a partial PDF, or
+    None if the file doesn't exist or isn't a partial PDF.
+    """
+    try:
+        info = PdfReader(str(path)).Info
+    except (OSError, PdfParseError):
+        return None
+    if not info or not info.Exhibiter:
+        return None
+    return json.loads(info.Exhibiter.to_unicode())
 
 
 def write_list(
@@ -294,16 +928,22 @@ def write_list(
                 end = document['page_span'][1]
                 index = exhibit.index
                 
-                if len(exhibit.documents) == 1:
+                if len(exhibit.documents) == 1 and exhibit.bates_prefix is None:
                     pass
                 elif end > start:
-                    index = f'{index}-{start}\nto\n{index}-{end}'
+                    index = (
+                        f'{exhibit.page_label(start)}\nto\n'
+                        + exhibit.page_label(end)
+                    )
                 else:
-                    index = f'{index}-{start}'
+                    index = exhibit.page_label(start)
+                if exhibit.bates_prefix is not None and index != exhibit.index:
+                    index = f'{exhibit.index}\n{index}'
                 
                 new_exhibit = Exhibit(
                     index = index,
                     title = document['name'],
+                    render = False,
                 )
                 new_exhibit.documents = [document]
                 new_exhibits.append(new_exhibit)
@@ -345,8 +985,16 @@ def write_list(
                 paragraph = row.cells[3].add_paragraph()
             description = doc["name"]
             
-            if len(exhibit.documents) > 1 and show_page_numbers:
-                span = doc['page_span']
+            # Bates ranges are shown even for one-document exhibits, since
+            # unlike page numbers, they can't be worked out from the index
+            span = doc['page_span']
+            if exhibit.bates_prefix is not None and show_page_numbers:
+                first, last = [exhibit.page_label(p) for p in span]
+                if span[1] - span[0] > 0:
+                    description += f' ({first}-{last})'
+                else:
+                    description += f' ({first})'
+            elif len(exhibit.documents) > 1 and show_page_numbers:
                 if span[1] - span[0] > 0:
                     description += f' (pp.{span[0]}-{span[1]})'
                 else:
@@ -358,7 +1006,7 @@ def write_list(
 
     if reserve_rebuttal:
         # calculate the next exhibit number or letter
-        last_index = exhibits[-1].index
+        last_index = exhibits[-1].index.split('\n')[0]
         if '-' in last_index:
             last_index = last_index.split('-')[0]
         if search("[A-Y]", last_index):
@@ -374,6 +1022,168 @@ def write_list(
             row.cells[c].paragraphs[0].alignment = WD_ALIGN_PARAGRAPH.CENTER
 
     exhibit_list.save(output_path)
+    _emit("stage_done", stage="list", path=output_path)
+
+
+def text_index_path(pdf_path: str) -> Path:
+    """Get the path of the full-text index that goes with an output PDF."""
+    return Path(pdf_path).with_suffix(TEXT_INDEX_SUFFIX)
+
+
+def write_text_index(exhibits: list[Exhibit], index_path: str):
+    """
+    Save the text of the given exhibits' pages to a full-text index,
+    for search_text_index(). The index is an SQLite FTS5 database, in
+    which each page's text is filed under its page label.
+
+    If the index already exists, it is updated: exhibits that it already
+    has (judging by their fingerprints) are kept as they are, exhibits
+    that aren't given anymore are removed, and the rest are added. So
+    only the exhibits being added need extract_text, and the others may
+    be unrendered outlines.
+    """
+    connection = sqlite3.connect(str(index_path))
+    with connection:
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS exhibits"
+            + " (fingerprint TEXT PRIMARY KEY, position INTEGER, exhibit TEXT)"
+        )
+        connection.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS pages USING fts5"
+            + "(fingerprint UNINDEXED, page UNINDEXED, label UNINDEXED, text)"
+        )
+        existing = read_index_fingerprints(index_path, connection)
+        rows = []
+        for position, exhibit in enumerate(exhibits):
+            # exhibits made without from_path() are identified by their text
+            fingerprint = exhibit.fingerprint
+            if fingerprint is None and exhibit.page_texts is not None:
+                texts = json.dumps(exhibit.page_texts).encode()
+                fingerprint = sha1(texts).hexdigest()
+            rows.append((fingerprint, position, exhibit.index))
+            if fingerprint in existing:
+                continue
+            if exhibit.page_texts is None:
+                raise ValueError(f"Exhibit {exhibit.index}'s text was not extracted.")
+            connection.executemany(
+                "INSERT INTO pages VALUES (?, ?, ?, ?)",
+                [
+                    (fingerprint, page, label, text)
+                    for page, (label, text) in enumerate(exhibit.page_texts)
+                ],
+            )
+        stale = existing - {row[0] for row in rows}
+        connection.executemany(
+            "DELETE FROM pages WHERE fingerprint = ?", [(f,) for f in stale]
+        )
+        connection.execute("DELETE FROM exhibits")
+        connection.executemany("INSERT INTO exhibits VALUES (?, ?, ?)", rows)
+        if stale:
+            # merge the index's segments, so that deleted pages stop
+            # taking up space
+            connection.execute("INSERT INTO pages(pages) VALUES ('optimize')")
+    connection.close()
+    _emit("stage_done", stage="index", path=index_path)
+
+
+def read_index_fingerprints(index_path: str, connection=None) -> set:
+    """
+    Get the fingerprints of the exhibits in a full-text index made by
+    write_text_index(). Returns an empty set if there is no index.
+    """
+    if connection is None:
+        if not Path(index_path).exists():
+            return set()
+        connection = sqlite3.connect(str(index_path))
+    try:
+        rows = connection.execute("SELECT fingerprint FROM exhibits").fetchall()
+    except sqlite3.OperationalError:  # the tables haven't been made yet
+        return set()
+    return {fingerprint for fingerprint, in rows}
+
+
+def search_text_index(index_path: str, query: str, phrase: bool = True) -> list:
+    """
+    Find the pages in a full-text index whose text matches the query,
+    and return a list of (exhibit, page label, snippet) tuples, in the
+    order the pages appear in the PDF. The snippet shows the matching
+    words [in brackets].
+
+    By default, the query is a phrase to look for, ignoring case and
+    punctuation. If phrase is False, the query can also use SQLite's
+    full-text query syntax, e.g. 'lease AND (deposit OR "last month")'
+    or 'evict*'.
+    """
+    if not Path(index_path).exists():
+        raise FileNotFoundError(f"There is no search index at '{index_path}'.")
+    if phrase:
+        query = '"' + query.replace('"', '""') + '"'
+    connection = sqlite3.connect(str(index_path))
+    try:
+        return connection.execute(
+            "SELECT exhibits.exhibit, pages.label,"
+            + " snippet(pages, 3, '[', ']', '...', 12)"
+            + " FROM pages JOIN exhibits USING (fingerprint)"
+            + " WHERE pages MATCH ? ORDER BY exhibits.position, pages.page",
+            (query,),
+        ).fetchall()
+    except sqlite3.OperationalError as e:
+        raise SyntaxError(f"Invalid search '{query}': {e}")
+    finally:
+        connection.close()
+
+
+def subscribe(callback):
+    """
+    Call the given function whenever something happens during a build,
+    like callback(event, **info). Events and their info are:
+
+    - "exhibit_started": index, title, path
+    - "page_rendered": index, page (the exhibit's page count so far)
+    - "document_finished": index, name, page_span
+    - "document_failed": index, path, reason (see Exhibit.from_path)
+    - "exhibit_finished": index, pages
+    - "bytes_written": path, bytes (the total written so far)
+    - "stage_done": stage ("pdf", "list" or "index"), path
+
+    Callbacks are only called for work done in the current process.
+    """
+    _listeners.append(callback)
+
+
+def unsubscribe(callback):
+    """Stop calling a function that was passed to subscribe()."""
+    _listeners.remove(callback)
+
+
+def _emit(event: str, **info):
+    for callback in _listeners:
+        callback(event, **info)
+
+
+class _ProgressFile:
+    """A writable file that emits "bytes_written" events as it goes."""
+
+    interval = 2**20
+
+    def __init__(self, f, path):
+        self.f = f
+        self.path = path
+        self.written = 0
+        self.reported = 0
+
+    def write(self, data):
+        self.f.write(data)
+        self.written += len(data)
+        if self.written - self.reported >= self.interval:
+            self.reported = self.written
+            _emit("bytes_written", path=self.path, bytes=self.written)
+
+    def flush(self):
+        self.f.flush()
+        if self.written != self.reported:
+            self.reported = self.written
+            _emit("bytes_written", path=self.path, bytes=self.written)
 
 
 def evidence_in_dir(folder: Path, respect_exclusions: bool = True):
@@ -393,6 +1203,439 @@ def evidence_in_dir(folder: Path, respect_exclusions: bool = True):
     #     raise FileNotFoundError(f"{folder} doesn't seem to contain any evidence.")
 
 
+def exhibit_index(exhibit_path: Path) -> str:
+    """Get an exhibit's number or letter from its file or folder name."""
+    return _process_filename(exhibit_path.name, False).split(". ", 1)[0]
+
+
+def files_in_doc(doc_path: Path, respect_exclusions: bool = True) -> list:
+    """
+    List the files that make up a document, in the order they will
+    appear in the exhibit. A document can be a single file or a folder
+    full of files.
+    """
+    if not doc_path.is_dir():
+        return [doc_path]
+    file_paths = []
+    for extension in FILE_TYPES:
+        file_paths += doc_path.glob("**/*." + extension)
+    return [
+        path for path in sorted(file_paths)
+        if not (respect_exclusions and search(EXCLUDE_PATTERN, path.name))
+    ]
+
+
+def count_pages(path: Path) -> int:
+    """Count the pages that a PDF or image file will take up."""
+    if path.suffix in [".pdf", ".PDF"]:
+        # each file is only counted once, so don't fill the cache with it
+        return len(PdfReader(str(path)).pages)
+    return 1
+
+
+def _isolated_main():
+    """
+    Entry point for the helper processes that Exhibit uses to read files
+    when it has time or memory limits. Reads requests from stdin, one
+    JSON list per line: "render" or "count", the file's path, and
+    rotate_landscape_pics. Answers each with a JSON line, either
+    {"size": n} followed by n bytes of the drawn PDF or the page count,
+    or {"error": message}. Sends {"size": 0} when it's ready to start.
+    """
+    global READER_CACHE_BYTES
+    READER_CACHE_BYTES = 0  # memory limits apply to one file at a time
+    requests, responses = sys.stdin.buffer, sys.stdout.buffer
+    sys.stdout = sys.stderr  # keep stray output out of the responses
+    responses.write(b'{"size": 0}\n')  # ready, once Python has started
+    responses.flush()
+    for line in requests:
+        mode, path, rotate = json.loads(line)
+        try:
+            if mode == "count":
+                data = str(count_pages(Path(path))).encode()
+            else:
+                exhibit = Exhibit(
+                    "", number_pages=False, rotate_landscape_pics=rotate
+                )
+                exhibit._insert_pdf_or_image(Path(path))
+                data = exhibit.pdf_data
+                del exhibit
+            response = {"size": len(data)}
+        except MemoryError:
+            # the process may be in a bad state, so let a new one take over
+            responses.write(b'{"error": "MemoryError"}\n')
+            responses.flush()
+            return
+        except Exception as e:
+            data = b""
+            response = {"error": f"{type(e).__name__}: {e}"}
+        responses.write(json.dumps(response).encode() + b"\n" + data)
+        responses.flush()
+
+
+class _SandboxError(Exception):
+    """Raised when a _Sandbox can't read a file. The message is why."""
+
+
+class _Sandbox:
+    """
+    A helper process that reads files for exhibits with time or memory
+    limits, so that a file that hangs, crashes or needs too much memory
+    can't bring down the process that's building the exhibit. The same
+    helper reads many files, since starting Python for each one takes
+    longer than reading most files. It's replaced whenever it has to be
+    stopped. Each process has one sandbox per memory limit, in
+    _sandboxes; they aren't meant to be shared between threads.
+    """
+
+    def __init__(self, memory_limit: int = None):
+        self.memory_limit = memory_limit  # in megabytes
+        self.process = None
+        self.responses = None
+
+    def run(self, request: list, time_limit: float = None) -> bytes:
+        """
+        Send a request to the helper (see _isolated_main) and return its
+        answer, or raise a _SandboxError if the helper fails or takes
+        more than time_limit seconds. If the helper can't even start,
+        that's a problem with the limits, not the file, so start() raises
+        a RuntimeError instead.
+        """
+        if self.process is None:
+            self.start()
+        try:
+            self.process.stdin.write(json.dumps(request).encode() + b"\n")
+            self.process.stdin.flush()
+            response, data = self.responses.get(timeout=time_limit)
+        except Empty:
+            self.stop()
+            raise _SandboxError(f"took longer than {time_limit} seconds")
+        except OSError:  # the helper has already exited
+            response, data = None, None
+        too_big = f"used more than {self.memory_limit} MB of memory"
+        if response is None:
+            self.stop()
+            # with no answer, there's no telling whether the helper ran
+            # out of memory, but that's the likeliest reason
+            raise _SandboxError(too_big if self.memory_limit else "crashed")
+        if "error" in response:
+            if response["error"] == "MemoryError":
+                self.stop()
+                if self.memory_limit:
+                    raise _SandboxError(too_big)
+            raise _SandboxError(f"could not be read ({response['error']})")
+        return data
+
+    def start(self):
+        """Start the helper, or raise a RuntimeError if it can't start."""
+        limit = self.memory_limit and self.memory_limit * 2**20
+        failed = RuntimeError(
+            "The helper process for reading files could not start"
+            + (f" with a memory limit of {self.memory_limit} MB." if limit else ".")
+        )
+
+        def limit_memory():
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+        try:
+            self.process = subprocess.Popen(
+                [
+                    sys.executable,
+                    "-c",
+                    "from exhibiter import _isolated_main; _isolated_main()",
+                ],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                preexec_fn=limit_memory if limit else None,
+            )
+        except (OSError, subprocess.SubprocessError) as e:
+            raise failed from e
+        # read the answers in a thread, so that run() can stop waiting
+        self.responses = Queue()
+        Thread(
+            target=self._read_responses,
+            args=(self.process.stdout, self.responses),
+            daemon=True,
+        ).start()
+        # wait until it's ready, so that starting up doesn't count
+        # towards the first file's time limit
+        response, _ = self.responses.get()
+        if response is None:
+            self.stop()
+            raise failed
+
+    def stop(self) -> int:
+        """Stop the helper, and return its exit code."""
+        self.process.kill()
+        returncode = self.process.wait()
+        self.process.stdin.close()
+        self.process = None
+        return returncode
+
+    @staticmethod
+    def _read_responses(stdout, responses: Queue):
+        for line in stdout:
+            try:
+                response = json.loads(line)
+            except ValueError:  # cut off when the helper was stopped
+                break
+            data = stdout.read(response.get("size", 0))
+            if len(data) < response.get("size", 0):
+                break
+            responses.put((response, data))
+        responses.put((None, None))  # the helper has exited
+
+
+def _read_pdf(path: Path) -> PdfReader:
+    """
+    Parse the PDF at the given path, reusing the result of an earlier
+    call if an identical file has already been read. The least recently
+    used readers are dropped once the cached files add up to more than
+    READER_CACHE_BYTES, since each reader keeps its whole file in memory.
+    """
+    data = path.read_bytes()
+    key = sha1(data).hexdigest()
+    reader, size = _reader_cache.pop(key, (None, len(data)))
+    if reader is None:
+        reader = PdfReader(fdata=data)
+    _reader_cache[key] = (reader, size)
+    cached = sum(size for _, size in _reader_cache.values())
+    while cached > READER_CACHE_BYTES:
+        _, (_, dropped) = _reader_cache.popitem(last=False)
+        cached -= dropped
+    return reader
+
+
+def _form_text(form, resources=None, seen: set = None) -> str:
+    """
+    Extract the text that a form XObject (such as a page made into one
+    by pdfrw's pagexobj) draws, in the order it's drawn, including the
+    text of any forms it draws in turn. This only aims to be good enough
+    for searching: text is decoded with each font's ToUnicode map if it
+    has one, or as Windows-1252 otherwise, and text from composite fonts
+    without a ToUnicode map is skipped.
+    """
+    resources = form.Resources or resources or PdfDict()
+    seen = seen if seen is not None else set()
+    seen.add(id(form))
+    try:
+        data = _stream_data(form)
+    except (ValueError, zlib.error):
+        return ""
+    if data is None:
+        return ""
+    # leave out inline images, whose binary data can't be tokenized
+    data = sub(rb"\bBI\b.*?\bEI\b", b"", data, flags=DOTALL)
+
+    fonts = resources.Font or PdfDict()
+    xobjects = resources.XObject or PdfDict()
+    decode = None
+    text = []
+    operands = []
+    for token in PdfTokens(data.decode("latin-1")):
+        if isinstance(token, PdfString) or token[0] in "/[]<>(-+.0123456789":
+            operands.append(token)
+            continue
+        if token == "Tf" and len(operands) >= 2:
+            font = fonts[operands[-2]]
+            decode = _font_decoder(font) if font is not None else None
+        elif token in ("Tj", "'", '"') and operands:
+            if token != "Tj":
+                text.append("\n")
+            if decode and isinstance(operands[-1], PdfString):
+                text.append(decode(operands[-1].to_bytes()))
+        elif token == "TJ":
+            for operand in operands:
+                if isinstance(operand, PdfString):
+                    if decode:
+                        text.append(decode(operand.to_bytes()))
+                elif fullmatch(r"-\d+\.?\d*", operand) and float(operand) < -250:
+                    text.append(" ")  # a gap wide enough to be a space
+        elif token in ("Td", "TD") and operands:
+            try:
+                moved = float(operands[-1])
+            except ValueError:  # a malformed operand
+                moved = 0
+            text.append("\n" if moved else " ")
+        elif token in ("T*", "Tm", "ET"):
+            text.append("\n")
+        elif token == "Do" and operands:
+            xobject = xobjects[operands[-1]]
+            if (
+                xobject is not None
+                and xobject.Subtype == "/Form"
+                and id(xobject) not in seen
+            ):
+                text.append("\n" + _form_text(xobject, resources, seen) + "\n")
+        operands = []
+
+    lines = (" ".join(line.split()) for line in "".join(text).splitlines())
+    return "\n".join(line for line in lines if line)
+
+
+def _stream_data(obj) -> bytes:
+    """
+    Get a PDF stream's decoded data, or None if it uses a filter that
+    can't be decoded here.
+    """
+    if obj.stream is None:
+        return None
+    data = obj.stream.encode("latin-1")  # pdfrw reads streams as latin-1
+    filters = obj.Filter
+    if not isinstance(filters, PdfArray):
+        filters = [filters] if filters else []
+    for name in filters:
+        if name in ("/FlateDecode", "/Fl"):
+            data = zlib.decompress(data)
+        elif name in ("/ASCII85Decode", "/A85"):
+            data = data.strip()
+            data = a85decode(data, adobe=data.endswith(b"~>"))
+        else:
+            return None
+    return data
+
+
+def _font_decoder(font):
+    """Make a function that turns a font's character codes into text."""
+    cmap = font.ToUnicode
+    if cmap is not None:
+        try:
+            data = _stream_data(cmap)
+        except (ValueError, zlib.error):
+            data = None
+        if data:
+            mapping, width = _parse_cmap(data.decode("latin-1"))
+            return lambda codes: "".join(
+                mapping.get(codes[i : i + width], "")
+                for i in range(0, len(codes), width)
+            )
+    if font.Subtype == "/Type0":
+        return None
+    return lambda codes: codes.decode("cp1252", errors="replace")
+
+
+def _parse_cmap(cmap: str) -> tuple:
+    """
+    Read the bfchar and bfrange mappings from a ToUnicode CMap. Returns
+    a dict from character codes to text, and the codes' width in bytes.
+    """
+    def text(hex_string):
+        return bytes.fromhex(hex_string).decode("utf-16-be", errors="replace")
+
+    mapping = {}
+    width = 1
+    for block in findall(r"beginbfchar(.*?)endbfchar", cmap, flags=DOTALL):
+        for code, value in findall(r"<(\w+)>\s*<(\w*)>", block):
+            mapping[bytes.fromhex(code)] = text(value)
+            width = len(code) // 2
+    for block in findall(r"beginbfrange(.*?)endbfrange", cmap, flags=DOTALL):
+        ranges = findall(r"<(\w+)>\s*<(\w+)>\s*(<\w*>|\[[^\]]*\])", block)
+        for low, high, value in ranges:
+            width = len(low) // 2
+            first, last = int(low, 16), int(high, 16)
+            if value.startswith("["):
+                values = [text(v) for v in findall(r"<(\w*)>", value)]
+            else:
+                # the last byte counts up through the range
+                start = bytes.fromhex(value[1:-1])
+                values = [
+                    (start[:-1] + bytes([(start[-1] + i) % 256])).decode(
+                        "utf-16-be", errors="replace"
+                    )
+                    for i in range(last - first + 1)
+                ]
+            for i, value in enumerate(values[: last - first + 1]):
+                mapping[(first + i).to_bytes(width, "big")] = value
+    return mapping, width
+
+
+class _ResourcePool:
+    """
+    Replaces resources (fonts, images, etc.) with identical copies that
+    have been seen before, so that they are written to the output only
+    once, however many pages, documents or exhibits use them.
+    """
+
+    def __init__(self):
+        self.canonical = {}  # an object's contents: the object to use
+        # id of an object seen before: (the object, the object to use).
+        # Keeping the objects alive keeps their ids from being reused.
+        self.done = {}
+        self.keys = {}  # id of an object seen before: what identifies it
+
+    def share(self, resources, indirect: bool = False):
+        """
+        Return a page's resource dictionary, with every indirect object
+        in it replaced by its shared copy. If indirect is True, the
+        dictionary itself is made indirect, so that if many pages have
+        identical dictionaries, it is written once instead of inline on
+        every page.
+        """
+        if indirect and isinstance(resources, PdfDict):
+            resources.indirect = resources.indirect or True
+        return self._share(resources)
+
+    def _share(self, obj):
+        if not isinstance(obj, (PdfDict, PdfArray)):
+            return obj
+        if id(obj) in self.done:
+            return self.done[id(obj)][1]
+        self.done[id(obj)] = (obj, obj)  # in case of cycles
+        self.keys[id(obj)] = ("object", id(obj))
+
+        # share the object's contents first, then the object itself
+        if isinstance(obj, PdfDict):
+            for key, value in obj.iteritems():
+                shared = self._share(value)
+                if shared is not value:
+                    obj[key] = shared
+            contents = (
+                obj.stream,
+                tuple(sorted(
+                    (key, self._identify(value))
+                    for key, value in obj.iteritems()
+                    if key != "/Length"
+                )),
+            )
+        else:
+            for i, value in enumerate(obj):
+                shared = self._share(value)
+                if shared is not value:
+                    obj[i] = shared
+            contents = tuple(self._identify(value) for value in obj)
+
+        # direct objects are identified by their contents, and indirect
+        # ones by which shared object they've been replaced with
+        if not obj.indirect:
+            self.keys[id(obj)] = ("direct", type(obj), contents)
+            return obj
+        shared = self.canonical.setdefault((type(obj), contents), obj)
+        self.done[id(obj)] = (obj, shared)
+        self.keys[id(obj)] = self.keys[id(shared)]
+        return shared
+
+    def _identify(self, value):
+        if isinstance(value, (PdfDict, PdfArray)):
+            return self.keys[id(value)]
+        return ("value", value)
+
+
+def _forget_doc(obj, rldoc, seen: set):
+    """
+    Recursively remove the ReportLab objects that pdfrw's toreportlab
+    attached to a cached PDF object while drawing it on a canvas.
+    """
+    if id(obj) in seen or not isinstance(obj, (PdfDict, PdfArray)):
+        return
+    seen.add(id(obj))
+    derived = getattr(obj, "derived_rl_obj", None)
+    if derived:
+        derived.pop(rldoc, None)
+    for child in obj.values() if isinstance(obj, PdfDict) else obj:
+        _forget_doc(child, rldoc, seen)
+
+
 def _process_filename(name: str, strip_leading_digits: bool = True) -> str:
     """
     Convert a filename into a document description.
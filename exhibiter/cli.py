@@ -5,36 +5,120 @@ described here: https://github.com/raindrum/exhibiter#usage."""
 
 # python standard imports
 from argparse import ArgumentParser
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from contextlib import contextmanager
+from functools import partial
+from multiprocessing import Queue
 from pathlib import Path
+from re import fullmatch
+from threading import Lock, Thread
+from time import perf_counter, time
+import csv
+import os
+import socket
 import sys
 
 # internal imports
-from exhibiter import Exhibit, evidence_in_dir, write_pdf, write_list
+from exhibiter import (
+    MEMORY_LIMITS_SUPPORTED,
+    PARTIAL_SUFFIX,
+    Exhibit,
+    evidence_in_dir,
+    exhibit_index,
+    read_fingerprints,
+    read_index_fingerprints,
+    read_partials,
+    search_text_index,
+    subscribe,
+    text_index_path,
+    unsubscribe,
+    write_pdf,
+    write_list,
+    write_partial,
+    write_text_index,
+    _listeners,
+    _partial_description,
+    _Sandbox,
+)
 
 # global variables
 DEFAULT_OUTPUT_PDF = "./Exhibits.pdf"
 DEFAULT_OUTPUT_LIST = "./Exhibit List.docx"
+DEFAULT_OUTPUT_DIR = "."
+CLAIM_REFRESH = 60  # how often to touch the claims of exhibits being rendered
+STALE_CLAIM = 600  # how long an untouched claim lasts, in seconds
 
 _description = __doc__
+_search_description = (
+    "This tool finds the pages of an exhibit PDF that contain a phrase, using"
+    + " the search index that 'exhibiter-cli --index' saves next to the PDF."
+)
+_merge_description = (
+    "This tool combines the partial PDFs saved by 'exhibiter-cli --partials'"
+    + " into a single PDF of evidence, plus a Word document that lists the"
+    + " evidence in detail."
+)
 
 
 def cli():
+    if sys.argv[1:2] == ["search"]:
+        search(sys.argv[2:])
+        return
+
     # Read command-line input
     parser = ArgumentParser(description=_description)
 
-    parser.add_argument("INPUT_FOLDER", help="path to a folder containing exhibits.")
+    parser.add_argument(
+        "INPUT_FOLDER",
+        nargs="*",
+        help="path to a folder containing exhibits. Several folders may be "
+        + "given to process many cases in one run.",
+    )
 
     parser.add_argument(
         "-o",
         "--output-files",
         help="specify where to save the two output files, respectively. "
-        + f"Defaults to '{DEFAULT_OUTPUT_PDF} {DEFAULT_OUTPUT_LIST}'.",
+        + f"Defaults to '{DEFAULT_OUTPUT_PDF} {DEFAULT_OUTPUT_LIST}'. "
+        + "Only used when there is a single input folder.",
         action="store",
         nargs=2,
         default=[DEFAULT_OUTPUT_PDF, DEFAULT_OUTPUT_LIST],
         metavar=("PDF_FILE", "DOCX_FILE"),
     )
 
+    parser.add_argument(
+        "-d",
+        "--output-dir",
+        help="when processing several input folders, save each folder's "
+        + "output files here, named after the folder. Defaults to the "
+        + "current directory.",
+        default=DEFAULT_OUTPUT_DIR,
+    )
+
+    parser.add_argument(
+        "-f",
+        "--job-file",
+        help="a CSV file whose rows each list an input folder, and "
+        + "optionally the PDF and DOCX files to save it to. Relative "
+        + "paths are relative to the job file.",
+    )
+
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="how many worker processes to render exhibits with. "
+        + "Defaults to the number of CPUs.",
+        type=int,
+        default=None,
+    )
+
     parser.add_argument(
         "-a", "--all", action="store_true", help='include files marked "(UNUSED)"'
     )
@@ -58,6 +142,30 @@ def cli():
         type=int,
     )
 
+    parser.add_argument(
+        "-b",
+        "--bates",
+        help="label pages with Bates numbers that run through the whole "
+        + "production, starting with this prefix, instead of exhibit "
+        + "page numbers",
+        metavar="PREFIX",
+    )
+
+    parser.add_argument(
+        "--bates-start",
+        help="the first Bates number. Defaults to %(default)s",
+        type=int,
+        default=1,
+    )
+
+    parser.add_argument(
+        "--bates-digits",
+        help="how many digits to zero-pad Bates numbers to. "
+        + "Defaults to %(default)s",
+        type=int,
+        default=6,
+    )
+
     parser.add_argument(
         "-l",
         "--allow-landscape",
@@ -65,6 +173,31 @@ def cli():
         help="don't rotate landscape photos in order to fill the page better",
     )
 
+    parser.add_argument(
+        "-w",
+        "--web-view",
+        action="store_true",
+        help='save a linearized ("fast web view") PDF, which browser-based '
+        + "viewers can start showing before it has fully downloaded. "
+        + "Requires pikepdf.",
+    )
+
+    parser.add_argument(
+        "-u",
+        "--append",
+        action="store_true",
+        help="if the output PDF already has the first exhibits, unchanged, "
+        + "only render the rest and add them to the end of the file",
+    )
+
+    parser.add_argument(
+        "-i",
+        "--index",
+        action="store_true",
+        help="also save a search index of the PDFs' text next to the output "
+        + "PDF, for 'exhibiter-cli search'",
+    )
+
     parser.add_argument(
         "-k",
         "--keep-leading-digits",
@@ -72,6 +205,99 @@ def cli():
         help='don\'t strip leading numbers (e.g. "1. ") from document names',
     )
 
+    _add_list_arguments(parser)
+
+    parser.add_argument(
+        "--time-limit",
+        help="read each file in a separate process, and give up on files "
+        + "that take longer than this many seconds",
+        type=float,
+        metavar="SECONDS",
+    )
+
+    parser.add_argument(
+        "--memory-limit",
+        help="read each file in a separate process, and give up on files "
+        + "that need more than this many megabytes of memory",
+        type=int,
+        metavar="MB",
+    )
+
+    parser.add_argument(
+        "--skip-failures",
+        action="store_true",
+        help="leave out files that exceed the time or memory limit, "
+        + "instead of replacing them with a placeholder page",
+    )
+
+    parser.add_argument(
+        "--partials",
+        help="instead of saving the output files, render the exhibits into "
+        + "partial PDFs in this folder, to be combined by exhibiter-merge. "
+        + "Several copies of this command, on one or more computers, can "
+        + "share the work through the same folder.",
+        metavar="FOLDER",
+    )
+
+    parser.add_argument(
+        "--exhibits",
+        help="with --partials, only render these exhibits, e.g. '101-110,115'",
+    )
+
+    parser.add_argument(
+        "-q",
+        "--quiet",
+        action="store_true",
+        help="don't show a progress bar",
+    )
+
+    if len(sys.argv) > 1:
+        args = parser.parse_args()
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+    try:
+        cases = _cases_from_args(args)
+    except ValueError as e:
+        parser.error(str(e))
+    if not cases:
+        parser.error("no input folders were given.")
+    if args.memory_limit and not MEMORY_LIMITS_SUPPORTED:
+        parser.error("--memory-limit isn't supported on this system.")
+    if args.memory_limit:
+        # a limit too low for Python to start in would otherwise fail
+        # every file, as if each one needed too much memory
+        sandbox = _Sandbox(args.memory_limit)
+        try:
+            sandbox.start()
+        except RuntimeError as e:
+            parser.error(str(e))
+        sandbox.stop()
+    if args.append and args.web_view:
+        parser.error("--append can't be used with --web-view.")
+    progress = None
+    if not args.quiet and sys.stderr.isatty():
+        progress = ProgressBar()
+    if args.partials:
+        if len(cases) > 1:
+            parser.error("--partials only works with one input folder.")
+        if args.index:
+            parser.error("--index can't be used with --partials.")
+        results = render_partials(cases[0][0], Path(args.partials), args, progress)
+        _print_summary(results, {"RENDER": "render_time"})
+    else:
+        results = run_batch(cases, args, progress)
+        if len(results) > 1 or results[0]["error"] or results[0]["failures"]:
+            _print_summary(
+                results, {"SCAN": "scan_time", "LIST": "list_time", "PDF": "pdf_time"}
+            )
+    if any(result["error"] for result in results):
+        sys.exit(1)
+
+
+def _add_list_arguments(parser: ArgumentParser):
+    """Add the options for the exhibit list to a parser."""
     parser.add_argument(
         "-p",
         "--party",
@@ -97,45 +323,740 @@ def cli():
         default=4,
     )
 
-    if len(sys.argv) > 1:
-        args = parser.parse_args()
+
+def _list_options(args) -> dict:
+    """Get write_list()'s keyword arguments from parsed arguments."""
+    return dict(
+        attachment_no=args.attachno,
+        party_label="Plaintiff" if args.party == "plaintiff" else "Defense",
+        reserve_rebuttal=not args.no_reserve_rebuttal,
+    )
+
+
+def _cases_from_args(args) -> list:
+    """
+    Get a list of (input folder, PDF file, DOCX file) tuples from the
+    command-line arguments. Default output names are numbered if several
+    input folders have the same name, and any other output file given
+    twice raises a ValueError.
+    """
+    cases = []
+    taken = set()
+    if args.job_file:
+        job_file = Path(args.job_file)
+        with open(job_file, newline="") as f:
+            for row in csv.reader(f):
+                row = [cell.strip() for cell in row]
+                if not row or not row[0] or row[0].startswith("#"):
+                    continue
+                input_dir = job_file.parent / row[0]
+                cells = (row[1:3] + ["", ""])[:2]
+                outputs = [job_file.parent / cell if cell else None for cell in cells]
+                # only take a default name if it's going to be used
+                if None in outputs:
+                    defaults = _default_outputs(input_dir, args, taken)
+                    outputs = [o or d for o, d in zip(outputs, defaults)]
+                cases.append((input_dir, *outputs))
+    if len(args.INPUT_FOLDER) == 1 and not cases:
+        cases.append((Path(args.INPUT_FOLDER[0]), *args.output_files))
     else:
-        parser.print_help()
-        sys.exit(1)
+        for folder in args.INPUT_FOLDER:
+            input_dir = Path(folder)
+            cases.append((input_dir, *_default_outputs(input_dir, args, taken)))
 
-    # Ensure input folder exists and contains exhibits
-    input_dir = Path(args.INPUT_FOLDER)
-    if not input_dir.is_dir():
-        print(f"Error: '{input_dir}' is not a real folder.")
-        return
-    exhibit_paths = evidence_in_dir(input_dir, not args.all)
-    if not exhibit_paths:
-        print(
-            f"Error: Input folder '{input_dir}' contains no exhibits, "
-            + "or they are all marked for exclusion."
-        )
+    # cases run at the same time, so they mustn't share output files
+    seen = set()
+    for case in cases:
+        for output in case[1:]:
+            output = Path(output).resolve()
+            if output in seen:
+                raise ValueError(f"'{output}' is the output of more than one case.")
+            seen.add(output)
+    return cases
 
-    # add all exhibits
-    exhibits = []
-    for path in exhibit_paths:
-        exhibits.append(
-            Exhibit.from_path(
+
+def _default_outputs(input_dir: Path, args, taken: set) -> tuple:
+    """
+    Name a batch case's output files after its input folder, numbering
+    them if the name is already in the taken set, which is updated.
+    """
+    output_dir = Path(args.output_dir)
+    name = input_dir.resolve().name
+    number = 1
+    while (output_dir / name).resolve() in taken:
+        number += 1
+        name = f"{input_dir.resolve().name} ({number})"
+    taken.add((output_dir / name).resolve())
+    return (
+        output_dir / f"{name} - {Path(DEFAULT_OUTPUT_PDF).name}",
+        output_dir / f"{name} - {Path(DEFAULT_OUTPUT_LIST).name}",
+    )
+
+
+def run_batch(cases: list, args, progress=None) -> list:
+    """
+    Build the output files for each (input folder, PDF file, DOCX file)
+    case. Returns a list of dicts describing how each case went.
+
+    The work runs as a pipeline. The exhibits are scanned in a shared
+    pool of worker processes, a few at a time, and each is sent back to
+    the pool to be rendered as soon as it has been scanned. Scanning also
+    counts every document's pages, so each exhibit list can be written
+    right away, while its PDF is assembled in a background thread as the
+    rendered exhibits arrive. With Bates numbers, the list is written
+    after the PDF instead, once every page count has been confirmed.
+
+    If a progress callback is given, it receives the events described
+    in exhibiter.subscribe(), including ones from the worker processes.
+    """
+    exhibit_options = _exhibit_options(args)
+    list_options = _list_options(args)
+    list_options["show_page_numbers"] = not args.no_page_numbers
+    jobs = args.jobs or os.cpu_count() or 1
+    results = []
+    with _worker_pool(args.jobs, progress) as pool, ThreadPoolExecutor(
+        max_workers=2 * len(cases)
+    ) as writers:
+        for input_dir, output_pdf, output_list in cases:
+            result = {
+                "input": input_dir,
+                "outputs": (output_pdf, output_list),
+                "error": None,
+                "failures": [],
+                "pages": 0,
+            }
+            results.append(result)
+            start = perf_counter()
+
+            # scan each exhibit and queue it for rendering right away.
+            # When appending, exhibits already in the output PDF are held
+            # back, unless it turns out that the PDF must be rewritten.
+            futures = []
+            scans = []
+            held = []
+            try:
+                for output in (output_pdf, output_list):
+                    Path(output).parent.mkdir(parents=True, exist_ok=True)
+                recorded = read_fingerprints(output_pdf) if args.append else []
+                if recorded and args.index:
+                    indexed = read_index_fingerprints(text_index_path(output_pdf))
+                outlines = []
+                bates_start = args.bates_start
+                # scan in the worker pool too, since with time or memory
+                # limits, reading each file takes a helper process. Only a
+                # few scans are queued at once, so that renders don't have
+                # to wait behind all of them.
+                paths = _exhibit_paths(input_dir, not args.all)
+                scan = partial(Exhibit.from_path, render=False, **exhibit_options)
+                for i, path in enumerate(paths):
+                    while len(scans) < min(len(paths), i + jobs):
+                        scans.append(pool.submit(scan, paths[len(scans)]))
+                    # the page count gives the next exhibit's Bates offset,
+                    # so every exhibit can be stamped in parallel
+                    options = dict(exhibit_options, bates_start=bates_start)
+                    outline = scans[i].result()
+                    outline.renumber(bates_start)
+                    outlines.append(outline)
+                    bates_start += outline.page_count
+                    position = len(futures)
+                    if position < len(recorded):
+                        if outline.fingerprint == recorded[position] and (
+                            not args.index or outline.fingerprint in indexed
+                        ):
+                            futures.append(_finished(outline))
+                            held.append((position, path, options))
+                            continue
+                        recorded = []
+                        _release(held, futures, pool, progress)
+                    futures.append(pool.submit(Exhibit.from_path, path, **options))
+                    if progress:
+                        progress.total += outline.page_count
+                if len(futures) < len(recorded):
+                    _release(held, futures, pool, progress)
+            except Exception as e:
+                result["error"] = f"{type(e).__name__}: {e}"
+                for future in futures + scans:
+                    future.cancel()
+                continue
+            result["scan_time"] = perf_counter() - start
+            result["pages"] = sum(e.page_count + 1 for e in outlines)
+
+            # the page spans are known, so write the list now, and the
+            # PDF as the exhibits are rendered. With Bates numbers, the
+            # list waits until every exhibit's page counts are confirmed,
+            # since numbers that overlap can't be fixed by rewriting it.
+            list_job = None
+            if args.bates is None:
+                list_job = writers.submit(
+                    _timed, start, write_list, outlines, output_list, **list_options
+                )
+            result["pdf_job"] = writers.submit(
+                _timed,
+                start,
+                _assemble_pdf,
+                futures,
+                outlines,
+                output_pdf,
+                args.web_view,
+                args.append,
+                args.index,
+                output_list,
+                list_job,
+                list_options,
+                result["failures"],
+            )
+            result["list_job"] = list_job or result["pdf_job"]
+
+        # wait for every case's output files
+        for result in results:
+            for stage in ["list", "pdf"]:
+                job = result.pop(f"{stage}_job", None)
+                if job is None:
+                    continue
+                try:
+                    result[f"{stage}_time"] = job.result()
+                except Exception as e:
+                    result["error"] = result["error"] or f"{type(e).__name__}: {e}"
+    return results
+
+
+def _finished(exhibit: Exhibit) -> Future:
+    """Wrap an exhibit that needs no rendering in a finished future."""
+    future = Future()
+    future.set_result(exhibit)
+    return future
+
+
+def _release(held: list, futures: list, pool, progress=None):
+    """
+    Render the held-back exhibits after all, because the output PDF
+    needs to be rewritten from the start.
+    """
+    for position, path, options in held:
+        outline = futures[position].result()
+        futures[position] = pool.submit(Exhibit.from_path, path, **options)
+        if progress:
+            progress.total += outline.page_count
+    held.clear()
+
+
+def render_partials(input_dir: Path, partials_dir: Path, args, progress=None):
+    """
+    Render the exhibits in an input folder into partial PDFs, for
+    exhibiter-merge to combine. Exhibits that another worker has claimed,
+    or that already have a partial PDF with the same fingerprint, are
+    skipped. Exhibits are only claimed when a worker process is free to
+    render them, so that other copies of this command can share the rest.
+    Returns a list of dicts describing how each exhibit went.
+    """
+    exhibit_options = _exhibit_options(args)
+    selected = _parse_selection(args.exhibits)
+    exhibit_paths = _exhibit_paths(input_dir, not args.all)
+    partials_dir.mkdir(parents=True, exist_ok=True)
+    jobs = args.jobs or os.cpu_count() or 1
+    results = []
+    pending = {}  # future: its exhibit's result
+    with _worker_pool(args.jobs, progress) as pool:
+        # Bates numbers depend on the page counts of every earlier
+        # exhibit, including ones that other workers will render
+        outlines = [None] * len(exhibit_paths)
+        if args.bates is not None:
+            scan = partial(Exhibit.from_path, render=False, **exhibit_options)
+            bates_start = args.bates_start
+            try:
+                for i, outline in enumerate(pool.map(scan, exhibit_paths)):
+                    outline.renumber(bates_start)
+                    outlines[i] = outline
+                    bates_start += outline.page_count
+            except Exception as e:
+                # without every page count, no exhibit can be numbered
+                error = f"{type(e).__name__}: {e}"
+                return [{"input": input_dir, "error": error, "failures": []}]
+
+        for position, path in enumerate(exhibit_paths):
+            index = exhibit_index(path)
+            if selected and not selected(index):
+                continue
+            partial_pdf = partials_dir / f"{position:04} - {index}{PARTIAL_SUFFIX}"
+            claim = partial_pdf.with_suffix(".claim")
+            result = {"input": path, "error": None, "failures": []}
+            # scan the exhibit, so that a partial PDF from an earlier run
+            # is only kept if the exhibit hasn't changed since
+            outline = outlines[position]
+            if outline is None:
+                try:
+                    outline = Exhibit.from_path(path, render=False, **exhibit_options)
+                except Exception as e:
+                    result["error"] = f"{type(e).__name__}: {e}"
+                    results.append(result)
+                    continue
+            current = (outline.fingerprint, len(exhibit_paths))
+            if _partial_version(partial_pdf) == current:
+                continue
+            while len(pending) >= jobs:
+                _wait_for_partials(pending)
+            if _partial_version(partial_pdf) == current:
+                continue
+            if not _claim(claim):
+                continue
+            results.append(result)
+            if progress:
+                progress.total += outline.page_count
+            result["start"] = perf_counter()
+            result["pages"] = outline.page_count + 1
+            result["claim"] = claim
+            future = pool.submit(
+                _render_partial,
                 path,
-                respect_exclusions=not args.all,
-                number_pages=not args.no_page_numbers,
-                page_label_coords=args.page_label_coords,
-                rotate_landscape_pics=not args.allow_landscape,
-                strip_leading_digits=not args.keep_leading_digits,
+                partial_pdf,
+                position,
+                len(exhibit_paths),
+                dict(exhibit_options, bates_start=outline.bates_start),
+                _spans(outline) if args.bates is not None else None,
             )
+            pending[future] = result
+
+        while pending:
+            _wait_for_partials(pending)
+    return results
+
+
+def _partial_version(partial_pdf: Path) -> tuple:
+    """
+    Get the fingerprint of a partial PDF's exhibit, and how many exhibits
+    there were when it was rendered, or None if there's no partial PDF.
+    """
+    description = _partial_description(partial_pdf)
+    if description is None:
+        return None
+    return description.get("fingerprint"), description["total"]
+
+
+def _wait_for_partials(pending: dict):
+    """
+    Wait until at least one of the pending partial PDFs is finished, and
+    record how it went. Meanwhile, keep the pending exhibits' claims
+    fresh, so that other workers can tell they are still being rendered.
+    """
+    done = set()
+    while not done:
+        for result in pending.values():
+            try:
+                os.utime(result["claim"])
+            except OSError:  # taken over by another worker (see _claim)
+                pass
+        done, _ = wait(pending, timeout=CLAIM_REFRESH, return_when=FIRST_COMPLETED)
+    for future in done:
+        result = pending.pop(future)
+        try:
+            result["failures"] = future.result()
+            result["render_time"] = perf_counter() - result["start"]
+        except Exception as e:
+            result["error"] = f"{type(e).__name__}: {e}"
+        result.pop("claim").unlink(missing_ok=True)
+
+
+def _render_partial(
+    path: Path,
+    partial: Path,
+    position: int,
+    total: int,
+    exhibit_options: dict,
+    spans: list = None,
+):
+    """
+    Render an exhibit into a partial PDF. If the exhibit's page spans
+    were counted beforehand, to give the later exhibits their Bates
+    numbers, check that they haven't changed since.
+    """
+    exhibit = Exhibit.from_path(path, **exhibit_options)
+    if spans is not None and _spans(exhibit) != spans:
+        raise RuntimeError(
+            "Some files' page counts changed since they were counted, so"
+            + " Bates numbers would overlap. Please run it again."
         )
+    write_partial(exhibit, partial, position, total)
+    return exhibit.failures
+
+
+def _spans(exhibit: Exhibit) -> list:
+    """List the page spans of an exhibit's documents."""
+    return [doc["page_span"] for doc in exhibit.documents]
+
+
+def _claim(claim: Path) -> bool:
+    """
+    Atomically create a claim file, so that only one worker renders each
+    exhibit. Returns False if the claim already exists, unless it's
+    stale, in which case it is taken over.
+    """
+    try:
+        fd = os.open(claim, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        if not _claim_is_stale(claim):
+            return False
+        # if two workers take over the same claim at once, the exhibit is
+        # just rendered twice, which does no harm: each writes its partial
+        # to its own temporary file, and copes with the claim being gone
+        claim.unlink(missing_ok=True)
+        return _claim(claim)
+    os.write(fd, f"{socket.gethostname()} {os.getpid()}".encode())
+    os.close(fd)
+    return True
+
+
+def _claim_is_stale(claim: Path) -> bool:
+    """
+    Check whether a claim was left behind by a worker that has stopped,
+    i.e. it hasn't been refreshed for STALE_CLAIM seconds, or it belongs
+    to a process on this computer that no longer exists.
+    """
+    try:
+        host, pid = claim.read_text().split()
+        age = time() - claim.stat().st_mtime
+    except (OSError, ValueError):  # gone, or still being written
+        return False
+    if age > STALE_CLAIM:
+        return True
+    # (on Windows, os.kill() would stop the process instead)
+    if host == socket.gethostname() and os.name == "posix":
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:  # someone else's process
+            pass
+    return False
+
+
+def _held_claims(partials_dir: Path) -> list:
+    """Describe the claims in a partials folder, for error messages."""
+    claims = []
+    for claim in sorted(partials_dir.glob("*.claim")):
+        try:
+            host, pid = claim.read_text().split()
+        except (OSError, ValueError):
+            continue
+        stale = " (abandoned)" if _claim_is_stale(claim) else ""
+        claims.append(f"'{claim.name}' is held by process {pid} on {host}{stale}.")
+    return claims
+
+
+def _parse_selection(selection: str):
+    """
+    Turn a selection like "101-110,115,A" into a function that says
+    whether a given exhibit index is selected.
+    """
+    if not selection:
+        return None
+    indices, ranges = set(), []
+    for part in selection.split(","):
+        part = part.strip()
+        if fullmatch(r"\d+-\d+", part):
+            ranges.append(tuple(int(x) for x in part.split("-")))
+        else:
+            indices.add(part)
+    return lambda index: index in indices or (
+        index.isdigit() and any(a <= int(index) <= b for a, b in ranges)
+    )
 
-    # Write output files
-    write_pdf(exhibits, args.output_files[0])
+
+def merge():
+    """
+    Combine the partial PDFs made by "exhibiter-cli --partials" into
+    the final evidence PDF and exhibit list.
+    """
+    parser = ArgumentParser(description=_merge_description)
+    parser.add_argument(
+        "PARTIALS_FOLDER", help="path to a folder containing partial PDFs."
+    )
+    parser.add_argument(
+        "-o",
+        "--output-files",
+        help="specify where to save the two output files, respectively. "
+        + f"Defaults to '{DEFAULT_OUTPUT_PDF} {DEFAULT_OUTPUT_LIST}'.",
+        action="store",
+        nargs=2,
+        default=[DEFAULT_OUTPUT_PDF, DEFAULT_OUTPUT_LIST],
+        metavar=("PDF_FILE", "DOCX_FILE"),
+    )
+    parser.add_argument(
+        "-w",
+        "--web-view",
+        action="store_true",
+        help='save a linearized ("fast web view") PDF. Requires pikepdf.',
+    )
+    parser.add_argument(
+        "-u",
+        "--append",
+        action="store_true",
+        help="if the output PDF already has the first exhibits, unchanged, "
+        + "only add the rest to the end of the file",
+    )
+    _add_list_arguments(parser)
+    args = parser.parse_args()
+
+    partials = sorted(Path(args.PARTIALS_FOLDER).glob(f"*{PARTIAL_SUFFIX}"))
+    try:
+        exhibits = read_partials(partials)
+    except (FileNotFoundError, SyntaxError, ValueError) as e:
+        print(f"Error: {e}")
+        for claim in _held_claims(Path(args.PARTIALS_FOLDER)):
+            print(claim)
+        sys.exit(1)
+    write_pdf(
+        exhibits, args.output_files[0], linearize=args.web_view, append=args.append
+    )
     write_list(
         exhibits,
         args.output_files[1],
-        attachment_no=args.attachno,
-        party_label="Plaintiff" if args.party == "plaintiff" else "Defense",
-        show_page_numbers=not args.no_page_numbers,
-        reserve_rebuttal=not args.no_reserve_rebuttal,
+        show_page_numbers=all(e.number_pages for e in exhibits),
+        **_list_options(args),
     )
+
+
+def search(argv: list = None):
+    """
+    Print the exhibit pages that contain a phrase, as found in the search
+    index saved by "exhibiter-cli --index".
+    """
+    parser = ArgumentParser(
+        prog="exhibiter-cli search", description=_search_description
+    )
+    parser.add_argument("PHRASE", help="the words to look for.")
+    parser.add_argument(
+        "-f",
+        "--file",
+        help="the exhibit PDF to search, or its search index. "
+        + "Defaults to '%(default)s'.",
+        default=DEFAULT_OUTPUT_PDF,
+    )
+    parser.add_argument(
+        "-q",
+        "--query",
+        action="store_true",
+        help="treat PHRASE as a full-text query, which can use AND, OR, NOT, "
+        + "\"quoted phrases\" and prefix* searches",
+    )
+    args = parser.parse_args(argv)
+
+    index_path = Path(args.file)
+    if index_path.suffix.lower() == ".pdf":
+        index_path = text_index_path(index_path)
+    try:
+        hits = search_text_index(index_path, args.PHRASE, phrase=not args.query)
+    except (FileNotFoundError, SyntaxError) as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    for exhibit, label, snippet in hits:
+        snippet = " ".join(snippet.split())
+        print(f"Exhibit {exhibit}, page {label}: {snippet}")
+    print(f"{len(hits)} matching pages.")
+
+
+def _exhibit_options(args) -> dict:
+    """Get Exhibit.from_path()'s keyword arguments from parsed arguments."""
+    return dict(
+        respect_exclusions=not args.all,
+        number_pages=not args.no_page_numbers,
+        page_label_coords=args.page_label_coords,
+        rotate_landscape_pics=not args.allow_landscape,
+        strip_leading_digits=not args.keep_leading_digits,
+        time_limit=args.time_limit,
+        memory_limit=args.memory_limit,
+        skip_failures=args.skip_failures,
+        extract_text=args.index,
+        bates_prefix=args.bates,
+        bates_start=args.bates_start,
+        bates_digits=args.bates_digits,
+    )
+
+
+@contextmanager
+def _worker_pool(jobs: int, progress=None):
+    """
+    Make a pool of worker processes. If there's a progress callback, the
+    workers' events are sent to it.
+    """
+    events = Queue() if progress else None
+    if progress:
+        subscribe(progress)
+        relay = Thread(target=_relay_events, args=(events, progress))
+        relay.start()
+    pool = ProcessPoolExecutor(
+        max_workers=jobs,
+        initializer=_forward_events,
+        initargs=(events,),
+    )
+    try:
+        yield pool
+    finally:
+        pool.shutdown()
+        if progress:
+            events.put(None)
+            relay.join()
+            unsubscribe(progress)
+            progress.close()
+
+
+def _exhibit_paths(input_dir: Path, respect_exclusions: bool) -> list:
+    """Find the exhibits in an input folder, or raise an error."""
+    if not input_dir.is_dir():
+        raise FileNotFoundError(f"'{input_dir}' is not a real folder.")
+    exhibit_paths = evidence_in_dir(input_dir, respect_exclusions)
+    if not exhibit_paths:
+        raise FileNotFoundError(
+            f"Input folder '{input_dir}' contains no exhibits, "
+            + "or they are all marked for exclusion."
+        )
+    return exhibit_paths
+
+
+def _assemble_pdf(
+    futures: list,
+    outlines: list,
+    output_pdf: Path,
+    linearize: bool,
+    append: bool,
+    index: bool,
+    output_list: Path,
+    list_job,
+    list_options: dict,
+    failures: list,
+):
+    """
+    Write a case's PDF, adding each exhibit as soon as it's rendered. If
+    any document's page span changed since it was scanned (e.g. a file
+    was edited mid-run, or couldn't be read), rewrite the exhibit list
+    to match. Files that couldn't be read are added to failures. If
+    index is True, update the PDF's search index too.
+
+    If there's no list_job, the exhibits have Bates numbers, and the list
+    is written after the PDF. Then a changed page span would make the
+    numbers overlap, so it stops the build before either file is saved.
+    """
+    exhibits = []
+
+    def rendered():
+        for future, outline in zip(futures, outlines):
+            exhibit = future.result()
+            if list_job is None and _spans(exhibit) != _spans(outline):
+                raise RuntimeError(
+                    "Some files' page counts changed during the build, so"
+                    + " Bates numbers would overlap. Please run it again."
+                )
+            exhibits.append(exhibit)
+            yield exhibit
+
+    write_pdf(rendered(), output_pdf, linearize=linearize, append=append)
+    if index:
+        write_text_index(exhibits, text_index_path(output_pdf))
+    for exhibit in exhibits:
+        failures += exhibit.failures
+    if list_job is None:
+        write_list(exhibits, output_list, **list_options)
+    elif list(map(_spans, exhibits)) != list(map(_spans, outlines)):
+        list_job.result()
+        write_list(exhibits, output_list, **list_options)
+
+
+def _timed(start: float, func, *args, **kwargs) -> float:
+    """Run a function, and return how long it's been since start."""
+    func(*args, **kwargs)
+    return perf_counter() - start
+
+
+def _print_summary(results: list, columns: dict):
+    """
+    Print the timings and failures from a run. The columns map headings
+    to the keys of the results' timings.
+    """
+    print(f"{'INPUT':40} {'PAGES':>6}" + "".join(f" {c:>7}" for c in columns))
+    for result in results:
+        name = str(result["input"])[-40:]
+        if result["error"]:
+            print(f"{name:40} FAILED: {result['error']}")
+            continue
+        print(
+            f"{name:40} {result['pages']:>6}"
+            + "".join(f" {result[key]:>6.1f}s" for key in columns.values())
+        )
+    failures = sum(1 for result in results if result["error"])
+    print(f"{len(results) - failures} of {len(results)} finished.")
+    for result in results:
+        for path, reason in result["failures"]:
+            print(f"Could not include '{path}': it {reason}.")
+
+
+def _forward_events(events: Queue):
+    """Make a worker process send its progress events to the main one."""
+    # forked workers inherit the main process's listeners, like its
+    # progress bar, which must only be called in the main process
+    _listeners.clear()
+    if events is not None:
+        subscribe(lambda event, **info: events.put((event, info)))
+
+
+def _relay_events(events: Queue, progress):
+    for event, info in iter(events.get, None):
+        progress(event, **info)
+
+
+class ProgressBar:
+    """
+    An event callback that shows a one-line progress bar with the pages
+    rendered per second and the estimated time remaining.
+    """
+
+    width = 30
+
+    def __init__(self, total: int = 0, stream=sys.stderr):
+        self.total = total
+        self.stream = stream
+        self.pages = 0
+        self.status = ""
+        self.start = perf_counter()
+        self.last_drawn = 0
+        self.lock = Lock()
+
+    def __call__(self, event: str, **info):
+        with self.lock:
+            if event == "page_rendered":
+                self.pages += 1
+            elif event == "bytes_written":
+                name = Path(info["path"]).name
+                self.status = f"writing {name} ({info['bytes'] / 2**20:.1f} MB)"
+            elif event == "stage_done":
+                self.status = f"saved {Path(info['path']).name}"
+            self.draw()
+
+    def draw(self, force: bool = False):
+        now = perf_counter()
+        if now - self.last_drawn < 0.1 and not force:
+            return
+        self.last_drawn = now
+        elapsed = now - self.start
+        rate = self.pages / elapsed if elapsed else 0
+        if rate and self.total >= self.pages:
+            eta = _format_time((self.total - self.pages) / rate)
+        else:
+            eta = "?"
+        filled = self.width * self.pages // self.total if self.total else 0
+        line = (
+            f"\r[{'#' * min(filled, self.width):{self.width}}]"
+            + f" {self.pages}/{self.total} pages, {rate:.1f} pages/s,"
+            + f" ETA {eta} {self.status}"
+        )
+        self.stream.write(line.ljust(79))
+        self.stream.flush()
+
+    def close(self):
+        with self.lock:
+            self.draw(force=True)
+            self.stream.write("\n")
+
+
+def _format_time(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    return f"{minutes}:{seconds:02}"
+
@@ -4,18 +4,377 @@ Before using it, you must organize the input folder into exhibits, as
 described <a href="https://github.com/raindrum/exhibiter#usage">here</a>."""
 
 # python standard imports
+import os
 import sys
+from hashlib import sha1
+from io import BytesIO
 from pathlib import Path
+from re import match
+from threading import Lock
 
 # third-party imports
 from PySide2 import QtCore, QtWidgets, QtGui
+from PIL import Image, ImageDraw
 
 # internal imports
-from exhibiter import Exhibit, evidence_in_dir, write_pdf, write_list
+from exhibiter import (
+    Exhibit,
+    evidence_in_dir,
+    files_in_doc,
+    count_pages,
+    write_pdf,
+    write_list,
+    _read_pdf,
+)
+
+# global variables
+THUMBNAIL_SIZE = (96, 124)
+THUMBNAIL_CACHE_BYTES = 256 * 2**20
+KEY_ROLE = QtCore.Qt.UserRole
+SOURCE_ROLE = QtCore.Qt.UserRole + 1
+
+# pdfrw readers aren't thread-safe, and they are shared through a cache
+_pdf_lock = Lock()
 
 _description = __doc__.replace("\n", " ")
 
 
+class ThumbnailCache:
+    """
+    A least-recently-used cache of page thumbnails, stored as PNG files
+    in a folder. Each thumbnail's key depends on its source file's path,
+    size and modification time, so edited files get new thumbnails.
+    """
+
+    def __init__(self, folder: Path, max_bytes: int = THUMBNAIL_CACHE_BYTES):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self._lock = Lock()
+        self._size = sum(f.stat().st_size for f in self.folder.glob("*.png"))
+
+    @staticmethod
+    def key(path: Path, page: int, rotate_landscape_pics: bool) -> str:
+        stat = path.stat()
+        return sha1(
+            f"{path.resolve()}|{stat.st_mtime_ns}|{stat.st_size}|{page}|"
+            f"{rotate_landscape_pics}|{THUMBNAIL_SIZE}".encode()
+        ).hexdigest()
+
+    def get(self, key: str) -> Path:
+        """Return the thumbnail's file if it's cached, else None."""
+        path = self.folder / f"{key}.png"
+        try:
+            os.utime(path)  # mark as recently used
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key: str, image: Image.Image) -> Path:
+        """Save a thumbnail, evicting old ones if the cache is full."""
+        path = self.folder / f"{key}.png"
+        temp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        image.save(temp_path, "PNG")
+        os.replace(temp_path, path)
+        with self._lock:
+            self._size += path.stat().st_size
+            if self._size > self.max_bytes:
+                self._prune()
+        return path
+
+    def _prune(self):
+        """Delete the least recently used thumbnails."""
+        files = sorted(
+            (f.stat().st_mtime, f.stat().st_size, f)
+            for f in self.folder.glob("*.png")
+        )
+        self._size = sum(size for _, size, _ in files)
+        for _, size, f in files:
+            if self._size <= self.max_bytes * 0.8:
+                break
+            f.unlink(missing_ok=True)
+            self._size -= size
+
+
+def make_thumbnail(
+    path: Path, page: int = 0, rotate_landscape_pics: bool = True
+) -> Image.Image:
+    """
+    Draw a small preview of how one page of a source file will look in
+    the evidence PDF. Images are drawn the way Exhibit places them on
+    the page. PDF pages show their largest embedded JPEG, if any, which
+    covers most scanned documents.
+    """
+    if path.suffix in [".pdf", ".PDF"]:
+        with _pdf_lock:
+            pdf_page = _read_pdf(path).pages[page]
+            box = [float(x) for x in pdf_page.inheritable.MediaBox]
+            rotation = int(pdf_page.inheritable.Rotate or 0) % 360
+            data = _largest_jpeg(pdf_page)
+        page_size = (box[2] - box[0], box[3] - box[1])
+        if rotation in (90, 270):
+            page_size = page_size[::-1]
+        image = Image.open(BytesIO(data)) if data else None
+        if image:
+            image.draft("RGB", THUMBNAIL_SIZE)  # fast JPEG downscaling
+        if image and rotation:
+            image = image.rotate(-rotation, expand=True)
+        margin = 1
+    else:
+        page_size = (612, 792)  # letter
+        image = Image.open(path)
+        image.draft("RGB", THUMBNAIL_SIZE)
+        if image.size[0] > image.size[1] and rotate_landscape_pics:
+            image = image.rotate(-90, expand=True)
+        margin = 0.9
+
+    # draw the page, then the picture on top of it
+    scale = min(THUMBNAIL_SIZE[0] / page_size[0], THUMBNAIL_SIZE[1] / page_size[1])
+    width, height = round(page_size[0] * scale), round(page_size[1] * scale)
+    thumbnail = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(thumbnail)
+    if image:
+        image = image.convert("RGB")
+        image.thumbnail((round(width * margin), round(height * margin)))
+        offset = ((width - image.size[0]) // 2, (height - image.size[1]) // 2)
+        thumbnail.paste(image, offset)
+    else:
+        draw.text((width // 2 - 10, height // 2 - 5), "PDF", fill="gray")
+    draw.rectangle((0, 0, width - 1, height - 1), outline="gray")
+    return thumbnail
+
+
+def _largest_jpeg(pdf_page) -> bytes:
+    """Get the raw data of the biggest JPEG image on a PDF page."""
+    resources = pdf_page.inheritable.Resources
+    xobjects = resources.XObject if resources else None
+    best, best_area = None, 0
+    for xobj in (xobjects or {}).values():
+        if xobj.Subtype != "/Image" or xobj.stream is None:
+            continue
+        filters = xobj.Filter
+        if not isinstance(filters, list):
+            filters = [filters]
+        if filters != ["/DCTDecode"]:
+            continue
+        area = int(xobj.Width) * int(xobj.Height)
+        if area > best_area:
+            best, best_area = xobj, area
+    return best.stream.encode("latin-1") if best else None
+
+
+class _ThumbnailSignals(QtCore.QObject):
+    finished = QtCore.Signal(str)
+
+
+class _ThumbnailJob(QtCore.QRunnable):
+    """Make one thumbnail in the background and save it to the cache."""
+
+    def __init__(self, cache, key, path, page, rotate_landscape_pics, signals):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.cache = cache
+        self.key = key
+        self.args = (path, page, rotate_landscape_pics)
+        self.signals = signals
+
+    def run(self):
+        try:
+            self.cache.put(self.key, make_thumbnail(*self.args))
+        except Exception:
+            pass  # leave the row without a thumbnail
+        self.signals.finished.emit(self.key)
+
+
+class _PageCountSignals(QtCore.QObject):
+    finished = QtCore.Signal(object, object)
+
+
+class _PageCountJob(QtCore.QRunnable):
+    """
+    List an exhibit's documents, their files, and how many pages each
+    file has, in the background.
+    """
+
+    def __init__(self, exhibit_path, respect_exclusions, signals):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.exhibit_path = exhibit_path
+        self.respect_exclusions = respect_exclusions
+        self.signals = signals
+
+    def run(self):
+        docs = []
+        try:
+            if self.exhibit_path.is_dir():
+                doc_paths = evidence_in_dir(self.exhibit_path, self.respect_exclusions)
+            else:
+                doc_paths = [self.exhibit_path]
+            for doc_path in doc_paths:
+                files = []
+                docs.append((doc_path, files))
+                for path in files_in_doc(doc_path, self.respect_exclusions):
+                    try:
+                        files.append((path, count_pages(path)))
+                    except Exception:
+                        files.append((path, 0))  # list the document anyway
+        except OSError:
+            pass  # the folder changed; show what was found
+        self.signals.finished.emit(self, docs)
+
+
+class PreviewTree(QtWidgets.QTreeWidget):
+    """
+    A list of exhibits, their documents, and the documents' pages, with
+    thumbnails. Thumbnails are only made for rows that are scrolled into
+    view, in a background thread pool, so large folders stay responsive.
+    """
+
+    def __init__(self, cache: ThumbnailCache):
+        super().__init__()
+        self.cache = cache
+        self.rotate_landscape_pics = True
+        self.respect_exclusions = True
+        self.setHeaderHidden(True)
+        self.setIconSize(QtCore.QSize(*THUMBNAIL_SIZE))
+        self.pool = QtCore.QThreadPool()
+        self.pool.setMaxThreadCount(max(1, QtCore.QThread.idealThreadCount() - 1))
+        self.pending = {}  # key: _ThumbnailJob
+        self.items = {}  # key: list of rows showing that thumbnail
+        self.signals = _ThumbnailSignals()
+        self.signals.finished.connect(self.thumbnail_ready)
+        self.counting = {}  # _PageCountJob: exhibit row
+        self.count_signals = _PageCountSignals()
+        self.count_signals.finished.connect(self.add_pages)
+
+        # wait for scrolling to settle before looking for visible rows
+        self.timer = QtCore.QTimer()
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(50)
+        self.timer.timeout.connect(self.request_visible)
+        self.verticalScrollBar().valueChanged.connect(self.timer.start)
+        self.itemExpanded.connect(self.populate)
+        self.itemExpanded.connect(self.timer.start)
+        self.itemCollapsed.connect(self.timer.start)
+
+    def load(
+        self,
+        input_dir: Path,
+        respect_exclusions: bool = True,
+        rotate_landscape_pics: bool = True,
+    ):
+        """List the exhibits in the given folder."""
+        for job in self.pending.values():
+            self.pool.tryTake(job)
+        for job in self.counting:
+            self.pool.tryTake(job)
+        self.pending = {}
+        self.counting = {}
+        self.items = {}
+        self.clear()
+        self.respect_exclusions = respect_exclusions
+        self.rotate_landscape_pics = rotate_landscape_pics
+        for path in evidence_in_dir(input_dir, respect_exclusions):
+            item = QtWidgets.QTreeWidgetItem([path.name])
+            item.setData(0, SOURCE_ROLE, path)
+            item.setChildIndicatorPolicy(QtWidgets.QTreeWidgetItem.ShowIndicator)
+            self.addTopLevelItem(item)
+
+    @QtCore.Slot(QtWidgets.QTreeWidgetItem)
+    def populate(self, exhibit_item):
+        """
+        Start listing an exhibit's documents and pages when it's expanded.
+        Pages are counted in the thread pool, so a placeholder row is shown
+        until add_pages gets the counts.
+        """
+        exhibit_path = exhibit_item.data(0, SOURCE_ROLE)
+        if exhibit_item.childCount() or exhibit_item.parent() or not exhibit_path:
+            return
+        exhibit_item.setChildIndicatorPolicy(
+            QtWidgets.QTreeWidgetItem.DontShowIndicatorWhenChildless
+        )
+        QtWidgets.QTreeWidgetItem(exhibit_item, ["Counting pages..."])
+        job = _PageCountJob(exhibit_path, self.respect_exclusions, self.count_signals)
+        self.counting[job] = exhibit_item
+        self.pool.start(job)
+
+    @QtCore.Slot(object, object)
+    def add_pages(self, job, docs):
+        """Replace an exhibit's placeholder row with its documents and pages."""
+        exhibit_item = self.counting.pop(job, None)
+        if exhibit_item is None:
+            return  # the tree was reloaded in the meantime
+        exhibit_item.takeChildren()
+        exhibit_path = exhibit_item.data(0, SOURCE_ROLE)
+        index = match(r"\d+|[A-Y]", exhibit_path.stem)
+        index = index.group(0) if index else "?"
+        page_no = 0
+        for doc_path, files in docs:
+            doc_item = QtWidgets.QTreeWidgetItem(exhibit_item, [doc_path.name])
+            for path, pages in files:
+                for page in range(pages):
+                    page_no += 1
+                    page_item = QtWidgets.QTreeWidgetItem(
+                        doc_item, [f"{index}-{page_no}  ({path.name})"]
+                    )
+                    self._add_thumbnail(page_item, path, page)
+                    if doc_item.data(0, KEY_ROLE) is None:
+                        self._add_thumbnail(doc_item, path, page)
+        self.timer.start()
+
+    def _add_thumbnail(self, item, path: Path, page: int):
+        key = self.cache.key(path, page, self.rotate_landscape_pics)
+        item.setData(0, KEY_ROLE, key)
+        item.setData(0, SOURCE_ROLE, (path, page))
+        self.items.setdefault(key, []).append(item)
+
+    @QtCore.Slot()
+    def request_visible(self):
+        """
+        Start making thumbnails for the rows on screen, and give up on
+        any queued thumbnails that have been scrolled out of view.
+        """
+        height = self.viewport().height()
+        visible = set()
+        item = self.itemAt(0, 0)
+        while item and self.visualItemRect(item).top() < height:
+            key = item.data(0, KEY_ROLE)
+            if key and item.icon(0).isNull():
+                visible.add(key)
+                self._request(item, key)
+            item = self.itemBelow(item)
+        for key, job in list(self.pending.items()):
+            if key not in visible and self.pool.tryTake(job):
+                del self.pending[key]
+
+    def _request(self, item, key: str):
+        if key in self.pending:
+            return
+        cached = self.cache.get(key)
+        if cached:
+            self._set_icon(key, cached)
+            return
+        path, page = item.data(0, SOURCE_ROLE)
+        job = _ThumbnailJob(
+            self.cache, key, path, page, self.rotate_landscape_pics, self.signals
+        )
+        self.pending[key] = job
+        self.pool.start(job)
+
+    @QtCore.Slot(str)
+    def thumbnail_ready(self, key: str):
+        if self.pending.pop(key, None) is None:
+            return  # the tree was reloaded in the meantime
+        cached = self.cache.get(key)
+        if cached:
+            self._set_icon(key, cached)
+
+    def _set_icon(self, key: str, file: Path):
+        icon = QtGui.QIcon(str(file))
+        for item in self.items.get(key, []):
+            item.setIcon(0, icon)
+
+
 class ExhibiterWidget(QtWidgets.QWidget):
     def __init__(self):
         super().__init__()
@@ -53,6 +412,7 @@ class ExhibiterWidget(QtWidgets.QWidget):
             + "has one of these words (with parentheses)."
         )
         self.exclusions_toggle.toggled.connect(self.trigger_exhibit_regen)
+        self.exclusions_toggle.toggled.connect(self.load_preview)
         self.layout.addWidget(self.exclusions_toggle)
 
         # container to hold the PDF and DOCX options sets
@@ -130,6 +490,7 @@ class ExhibiterWidget(QtWidgets.QWidget):
         )
         self.rotation_toggle.setChecked(True)
         self.rotation_toggle.toggled.connect(self.trigger_exhibit_regen)
+        self.rotation_toggle.toggled.connect(self.load_preview)
         pdf_box.addWidget(self.rotation_toggle)
 
         # page numbering toggle
@@ -142,6 +503,15 @@ class ExhibiterWidget(QtWidgets.QWidget):
         self.pagination_toggle.toggled.connect(self.toggle_page_labels)
         pdf_box.addWidget(self.pagination_toggle)
 
+        # linearization toggle
+        self.web_view_toggle = QtWidgets.QCheckBox("Fast web view")
+        self.web_view_toggle.setToolTip(
+            "Should the PDF be linearized, so that browser-based\n"
+            + "viewers can show its first pages before the whole\n"
+            + "file has downloaded? This requires pikepdf."
+        )
+        pdf_box.addWidget(self.web_view_toggle)
+
         # page label location setter
         self.page_coords_label = QtWidgets.QLabel("Page number coords (X, Y):")
         self.page_coords_spinbox_x = QtWidgets.QSpinBox()
@@ -174,6 +544,20 @@ class ExhibiterWidget(QtWidgets.QWidget):
         self.pdf_save_btn.clicked.connect(self.save_pdf)
         pdf_box.addWidget(self.pdf_save_btn)
 
+        # preview of exhibits, documents and pages
+        preview_heading = QtWidgets.QLabel("<b>Preview</b>")
+        preview_heading.setAlignment(QtCore.Qt.AlignCenter)
+        self.layout.addWidget(preview_heading)
+        cache_dir = QtCore.QStandardPaths.writableLocation(
+            QtCore.QStandardPaths.CacheLocation
+        )
+        self.preview = PreviewTree(ThumbnailCache(Path(cache_dir) / "thumbnails"))
+        self.preview.setToolTip(
+            "Expand an exhibit to see its documents and pages\n"
+            + "in the order they will appear in the PDF."
+        )
+        self.layout.addWidget(self.preview)
+
         # footer text
         footer = QtWidgets.QLabel(
             "Copyright 2021 Simon Raindrum Sherred.\n"
@@ -209,6 +593,7 @@ class ExhibiterWidget(QtWidgets.QWidget):
         if selection:
             self.input_dir = selection
             self.selected_dir = Path(selection).parent
+            self.load_preview()
             self.load_exhibits()
 
     @QtCore.Slot()
@@ -230,7 +615,11 @@ class ExhibiterWidget(QtWidgets.QWidget):
         if selection:
             output_pdf = Path(str(selection))
             self.selected_dir = str(output_pdf.parent)
-            write_pdf(self.exhibits, output_pdf)
+            write_pdf(
+                self.exhibits,
+                output_pdf,
+                linearize=self.web_view_toggle.isChecked(),
+            )
 
     @msg_if_fail
     @QtCore.Slot()
@@ -254,6 +643,17 @@ class ExhibiterWidget(QtWidgets.QWidget):
             )
             self.selected_dir = str(output_docx.parent)
 
+    @msg_if_fail
+    @QtCore.Slot()
+    def load_preview(self):
+        if not hasattr(self, "input_dir"):
+            return
+        self.preview.load(
+            Path(self.input_dir),
+            respect_exclusions=not self.exclusions_toggle.isChecked(),
+            rotate_landscape_pics=self.rotation_toggle.isChecked(),
+        )
+
     @QtCore.Slot()
     def toggle_page_labels(self):
         enabled = self.pagination_toggle.isChecked()
@@ -271,19 +671,20 @@ class ExhibiterWidget(QtWidgets.QWidget):
         # then add them all to the exhibit list
         self.exhibits = []
         for path in exhibit_paths:
-            self.exhibits.append(
-                Exhibit.from_path(
-                    path,
-                    respect_exclusions=not self.exclusions_toggle.isChecked(),
-                    number_pages=self.pagination_toggle.isChecked(),
-                    page_label_coords=(
-                        self.page_coords_spinbox_x.value(),
-                        self.page_coords_spinbox_y.value(),
-                    ),
-                    rotate_landscape_pics=self.rotation_toggle.isChecked(),
-                    strip_leading_digits=True,
+            with _pdf_lock:  # the preview may be reading the same PDFs
+                self.exhibits.append(
+                    Exhibit.from_path(
+                        path,
+                        respect_exclusions=not self.exclusions_toggle.isChecked(),
+                        number_pages=self.pagination_toggle.isChecked(),
+                        page_label_coords=(
+                            self.page_coords_spinbox_x.value(),
+                            self.page_coords_spinbox_y.value(),
+                        ),
+                        rotate_landscape_pics=self.rotation_toggle.isChecked(),
+                        strip_leading_digits=True,
+                    )
                 )
-            )
 
         # update the GUI
         self.exhibits_need_regen = False
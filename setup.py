@@ -15,7 +15,8 @@ setuptools.setup(
     url='https://github.com/raindrum/exhibiter',
     packages=setuptools.find_packages(),
     entry_points={
-        'console_scripts': ["exhibiter-cli = exhibiter.cli:cli"],
+        'console_scripts': ["exhibiter-cli = exhibiter.cli:cli",
+            "exhibiter-merge = exhibiter.cli:merge"],
         'gui_scripts': ["exhibiter = exhibiter.gui:gui"]},
     include_package_data=True,
     install_requires=[
@@ -24,6 +25,8 @@ setuptools.setup(
         'reportlab',
         'python-docx',
         'PySide2'],
+    extras_require={
+        'linearize': ['pikepdf']},
     classifiers=[
         'License :: Free To Use But Restricted',
         'Development Status :: 4 - Beta',